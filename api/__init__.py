@@ -1,10 +1,26 @@
-from ml_sdk.api.api import MLAPI
-from ml_sdk.api.parsers import FileParser, CSVFileParser, XLSXFileParser
+from importlib import import_module
+
+# Imported on first access (PEP 562), so loading the package doesn't pull
+# pandas and the backends in
+_EXPORTS = {
+    'MLAPI': 'ml_sdk.api.api',
+    'FileParser': 'ml_sdk.api.parsers',
+    'CSVFileParser': 'ml_sdk.api.parsers',
+    'ArrowCSVFileParser': 'ml_sdk.api.parsers',
+    'XLSXFileParser': 'ml_sdk.api.parsers',
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(_EXPORTS[name]), name)
 
 
 __all__ = [
     'FileParser',
     'CSVFileParser',
+    'ArrowCSVFileParser',
     'XLSXFileParser',
     'MLAPI',
 ]
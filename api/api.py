@@ -1,15 +1,17 @@
 import logging
+import threading
+import time
 import traceback
+from collections import defaultdict
+from contextlib import contextmanager
 from fastapi import (status,
                      UploadFile, BackgroundTasks,
-                     HTTPException, Depends)
+                     HTTPException, Depends, Query)
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import StreamingResponse, JSONResponse
-from typing import List, Annotated
-from ml_sdk.api.parsers import CSVFileParser
-from ml_sdk.communication.redis import RedisDispatcher, RedisSettings
-from ml_sdk.database.redis import RedisDatabase
-from ml_sdk.database.mongo import MongoDatabase, MongoSettings
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from typing import List, Dict, Annotated, Literal
+from ml_sdk import backends, metrics, tracing
+from ml_sdk.communication import BATCH, Overloaded, ServiceError
 from ml_sdk.io import (
     TestJob,
     TrainJob,
@@ -17,6 +19,7 @@ from ml_sdk.io import (
 )
 from ml_sdk.io.version import (ModelVersion, ModelDescription,
                                VersionID, AvailableModels)
+from ml_sdk.io.validation import build, build_list
 
 from ml_sdk.api.auth import Auth
 
@@ -31,10 +34,33 @@ class MLAPI(Auth):
     DESCRIPTION = None
     INPUT_TYPE = None
     OUTPUT_TYPE = None
-    COMMUNICATION_TYPE = RedisDispatcher
-    DATABASE_TYPE = RedisDatabase
-    FILE_PARSER = CSVFileParser
+    # Backend classes, or their names in ml_sdk.backends to import them
+    # only when used
+    COMMUNICATION_TYPE = 'redis'
+    DATABASE_TYPE = 'redis'
+    FILE_PARSER = 'csv'
     BATCH_SIZE = 1000
+    # Admission control, None disables each limit
+    MAX_QUEUE_DEPTH = None
+    MAX_CONCURRENT_PER_TOKEN = None
+    RETRY_AFTER = 1
+    # Seconds to wait for the service, TIMEOUTS overrides it by method
+    TIMEOUT = 10
+    TIMEOUTS = {}
+    # Outputs come from the services already validated, don't do it again
+    TRUSTED_OUTPUT = True
+    # Requests larger than this (bytes) are sent to services by reference
+    CLAIM_CHECK_THRESHOLD = None
+    # Serialization for queues and jobs, e.g. 'msgpack' or 'msgpack+zstd'
+    CODEC = 'msgpack'
+    # Stage test jobs for the services to run, instead of this process
+    RUN_TEST_JOBS_IN_WORKERS = False
+    # Break down /predict time by stage in a Server-Timing header
+    SERVER_TIMING = False
+    # Seconds to wait for every worker to answer profiling commands
+    PROFILE_WAIT = 1
+    # Redis shards as "host:port", the first one also takes broadcasts
+    REDIS_NODES = None
 
     def __init__(self):
 
@@ -43,22 +69,41 @@ class MLAPI(Auth):
         super().__init__()
 
         # Communication
-        if self.COMMUNICATION_TYPE == RedisDispatcher:
-            comm_settings = RedisSettings(topic=self.MODEL_NAME, host='redis')
+        from ml_sdk.communication.redis import RedisDispatcher, RedisSettings
+        self.COMMUNICATION_TYPE = backends.resolve('dispatcher',
+                                                   self.COMMUNICATION_TYPE)
+        if issubclass(self.COMMUNICATION_TYPE, RedisDispatcher):
+            comm_settings = RedisSettings(
+                topic=self.MODEL_NAME, host='redis',
+                max_queue_depth=self.MAX_QUEUE_DEPTH,
+                retry_after=self.RETRY_AFTER,
+                timeout=self.TIMEOUT,
+                timeouts=self.TIMEOUTS,
+                claim_check_threshold=self.CLAIM_CHECK_THRESHOLD,
+                codec=self.CODEC,
+                nodes=self.REDIS_NODES)
         else:
             raise NotImplementedError("Communication type not implemented")
         self.connector = self.COMMUNICATION_TYPE(comm_settings)
 
         # Database
-        if self.DATABASE_TYPE == RedisDatabase:
+        from ml_sdk.database.redis import RedisDatabase
+        self.DATABASE_TYPE = backends.resolve('database', self.DATABASE_TYPE)
+        if issubclass(self.DATABASE_TYPE, RedisDatabase):
             db_settings = RedisSettings(topic=f"{self.MODEL_NAME}_jobs",
-                                        host='redis')
-        elif self.DATABASE_TYPE == MongoDatabase:
-            db_settings = MongoSettings(db=self.MODEL_NAME, host='mongo')
+                                        host='redis', codec=self.CODEC,
+                                        nodes=self.REDIS_NODES)
         else:
-            raise NotImplementedError("Database type not implemented")
+            from ml_sdk.database.mongo import MongoDatabase, MongoSettings
+            if not issubclass(self.DATABASE_TYPE, MongoDatabase):
+                raise NotImplementedError("Database type not implemented")
+            db_settings = MongoSettings(db=self.MODEL_NAME, host='mongo')
         self.database = self.DATABASE_TYPE(db_settings)
 
+        # Requests in flight by token
+        self._in_flight = defaultdict(int)
+        self._in_flight_lock = threading.Lock()
+
         # API Routes
         self._add_routes()
         super()._add_routes()
@@ -71,8 +116,8 @@ class MLAPI(Auth):
         assert self.DATABASE_TYPE is not None, ("You have to setup"
                                                 " a DATABASE_TYPE")
         assert self.MODEL_NAME is not None, "You have to setup a MODEL_NAME"
-        assert callable(
-            self.FILE_PARSER), "You have to setup first a FILE_PARSER"
+        assert self.FILE_PARSER is not None, ("You have to setup"
+                                              " a FILE_PARSER")
         assert self.oauth2_scheme is not None, ("You have to setup"
                                                 " a oauth2_scheme")
 
@@ -101,6 +146,12 @@ class MLAPI(Auth):
                                   self.get_train(),
                                   methods=["GET"],
                                   response_model=TrainJob)
+        self.router.add_api_route("/version/workers",
+                                  self.get_workers(),
+                                  methods=["GET"])
+        self.router.add_api_route("/version/split",
+                                  self.post_split(),
+                                  methods=["POST"])
         self.router.add_api_route("/version/{version_id}",
                                   self.post_version(),
                                   methods=["POST"],
@@ -108,18 +159,61 @@ class MLAPI(Auth):
         self.router.add_api_route("/version",
                                   self.get_version(),
                                   methods=["GET"])
+        self.router.add_api_route("/queue",
+                                  self.get_queue(),
+                                  methods=["GET"])
+        self.router.add_api_route("/ready",
+                                  self.get_ready(),
+                                  methods=["GET"],
+                                  include_in_schema=False)
+        self.router.add_api_route("/profile/start",
+                                  self.post_profile_start(),
+                                  methods=["POST"])
+        self.router.add_api_route("/profile/stop",
+                                  self.post_profile_stop(),
+                                  methods=["POST"])
+        self.router.add_api_route("/profile/memory",
+                                  self.get_profile_memory(),
+                                  methods=["GET"])
+        self.router.add_api_route("/profile/memory",
+                                  self.delete_profile_memory(),
+                                  methods=["DELETE"])
+        if metrics.enabled:
+            self.router.add_api_route("/metrics",
+                                      self.get_metrics(),
+                                      methods=["GET"],
+                                      include_in_schema=False)
 
     # VIEWS
     def post_predict(self):
 
         def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
-                   input_: self.INPUT_TYPE) -> self.OUTPUT_TYPE:
-            try:
-                result = self.connector.dispatch('predict',
-                                                 input_=input_.dict())
-            except ValueError:
-                raise HTTPException(
-                    status_code=404, detail="Service timeout for predict")
+                   input_: self.INPUT_TYPE,
+                   response: Response,
+                   version: VersionID = None) -> self.OUTPUT_TYPE:
+            headers = {}
+            # Pinned version, otherwise the workers pick one by the split
+            kwargs = {'version': version} if version else {}
+            with self._token_slot(token):
+                try:
+                    if self.SERVER_TIMING:
+                        result, timings = self.connector.dispatch_timed(
+                            'predict', input_=input_.dict(), **kwargs)
+                        headers['Server-Timing'] = tracing.server_timing(
+                            timings)
+                    else:
+                        result = self.connector.dispatch(
+                            'predict', input_=input_.dict(), **kwargs)
+                except Overloaded as exc:
+                    raise self._unavailable(exc)
+                except ServiceError as exc:
+                    raise self._failed(exc)
+                except ValueError:
+                    raise HTTPException(
+                        status_code=404, detail="Service timeout for predict")
+            if self.TRUSTED_OUTPUT:
+                return JSONResponse(content=result, headers=headers)
+            response.headers.update(headers)
             return result
 
         return _inner
@@ -133,12 +227,12 @@ class MLAPI(Auth):
 
             # Return file or formatted response
             if as_file:
-                job.results = [
-                    self.OUTPUT_TYPE(**res) for res in job.results]
+                job.results = build_list(self.OUTPUT_TYPE, job.results,
+                                         trusted=self.TRUSTED_OUTPUT)
                 return self._create_file(job)
             else:
-                job.results = [
-                    self.OUTPUT_TYPE(**res) for res in job.results[:10]]
+                job.results = build_list(self.OUTPUT_TYPE, job.results[:10],
+                                         trusted=self.TRUSTED_OUTPUT)
                 return job
 
         return _inner
@@ -149,13 +243,19 @@ class MLAPI(Auth):
                    input_: FileInput,
                    background_tasks: BackgroundTasks) -> TestJob:
             # parsing
-            items = list(self._parse_file(input_))  # TODO consume 1 by 1
+            items, bad_lines = self._parse_file(input_)
 
             # job creation
-            job = self.database.create_test_job(total=len(items))
+            job = self.database.create_test_job(total=len(items),
+                                                bad_lines=bad_lines)
 
             # trigger tasks
-            self._async_predict(token, background_tasks, job=job, items=items)
+            if self.RUN_TEST_JOBS_IN_WORKERS:
+                self.database.stage_test_job(job, items)
+                background_tasks.add_task(self._send_batch, 'run_test_job',
+                                          job=job.dict())
+            else:
+                self._async_predict(background_tasks, job=job, items=items)
 
             return job
 
@@ -176,7 +276,7 @@ class MLAPI(Auth):
                    background_tasks: BackgroundTasks,
                    input_: FileInput) -> TrainJob:
             # parsing
-            items = list(self._parse_file(input_))  # TODO consume 1 by 1
+            items, _ = self._parse_file(input_)
             # TODO move this parsing to the async_train
             try:
                 for i in items:
@@ -212,6 +312,10 @@ class MLAPI(Auth):
 
             try:
                 result = self.connector.dispatch('available_versions')
+            except Overloaded as exc:
+                raise self._unavailable(exc)
+            except ServiceError as exc:
+                raise self._failed(exc)
             except ValueError:
                 raise HTTPException(
                     status_code=404,
@@ -225,19 +329,124 @@ class MLAPI(Auth):
     def post_version(self):
 
         def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
-                   version_id: VersionID) -> ModelVersion:
+                   version_id: VersionID,
+                   response: Response) -> ModelVersion:
             input_ = ModelVersion(version=version_id)
-            self.connector.broadcast('deploy', input_=input_.dict())
+            control_id = self.connector.broadcast('deploy',
+                                                  input_=input_.dict())
+            # Matches the acknowledgements listed by /version/workers
+            response.headers['X-Control-Id'] = control_id
+            return input_
+
+        return _inner
+
+    def post_split(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
+                   input_: Dict[VersionID, float],
+                   response: Response) -> Dict[VersionID, float]:
+            # Weights of the versions answering predicts without version
+            if any(weight < 0 for weight in input_.values()):
+                raise HTTPException(status_code=422,
+                                    detail="Weights can't be negative")
+            control_id = self.connector.broadcast('split', input_=input_)
+            response.headers['X-Control-Id'] = control_id
             return input_
 
         return _inner
 
+    def get_workers(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)]
+                   ) -> Dict[str, Dict]:
+            # Version each worker acknowledged, see /version/{version_id}
+            return self.connector.workers()
+
+        return _inner
+
+    def get_queue(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)]
+                   ) -> Dict[str, int]:
+            return self.connector.queue_depth()
+
+        return _inner
+
+    def get_ready(self):
+
+        def _inner() -> JSONResponse:
+            # Probed without a token, ready while any worker is warm
+            workers = self.connector.ready_workers()
+            return JSONResponse(
+                status_code=(status.HTTP_200_OK if workers
+                             else status.HTTP_503_SERVICE_UNAVAILABLE),
+                content={'workers': workers})
+
+        return _inner
+
+    def post_profile_start(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
+                   kind: Literal['sampling', 'cprofile'] = 'sampling',
+                   interval: float = Query(0.01, gt=0)) -> List[Dict]:
+            options = {'interval': interval} if kind == 'sampling' else {}
+            return self.connector.collect('profile_start',
+                                          wait=self.PROFILE_WAIT,
+                                          kind=kind, **options)
+
+        return _inner
+
+    def post_profile_stop(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
+                   limit: int = 50) -> List[Dict]:
+            return self.connector.collect('profile_stop',
+                                          wait=self.PROFILE_WAIT,
+                                          limit=limit)
+
+        return _inner
+
+    def get_profile_memory(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)],
+                   limit: int = 20, frames: int = 1) -> List[Dict]:
+            # The first call starts tracing allocations, the next ones
+            # return the growth since the previous call
+            return self.connector.collect('memory_snapshot',
+                                          wait=self.PROFILE_WAIT,
+                                          limit=limit, frames=frames)
+
+        return _inner
+
+    def delete_profile_memory(self):
+
+        def _inner(token: Annotated[str, Depends(self.oauth2_scheme)]
+                   ) -> List[Dict]:
+            return self.connector.collect('memory_stop',
+                                          wait=self.PROFILE_WAIT)
+
+        return _inner
+
+    def get_metrics(self):
+
+        def _inner() -> Response:
+            # Scraped without a token, like any Prometheus target
+            self.connector.queue_depth()
+            content, media_type = metrics.latest()
+            return Response(content=content, media_type=media_type)
+
+        return _inner
+
     def index(self):
 
         def _inner(token: Annotated[str, Depends(self.oauth2_scheme)]
                    ) -> ModelDescription:
             try:
                 version = self.connector.dispatch('enabled_version')
+            except Overloaded as exc:
+                raise self._unavailable(exc)
+            except ServiceError as exc:
+                raise self._failed(exc)
             except ValueError:
                 raise HTTPException(
                     status_code=404,
@@ -251,52 +460,116 @@ class MLAPI(Auth):
         return _inner
 
     # INTERNAL
+    @contextmanager
+    def _token_slot(self, token):
+        with self._in_flight_lock:
+            if (self.MAX_CONCURRENT_PER_TOKEN is not None and
+                    self._in_flight[token] >= self.MAX_CONCURRENT_PER_TOKEN):
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many concurrent requests",
+                    headers={"Retry-After": str(self.RETRY_AFTER)})
+            self._in_flight[token] += 1
+        try:
+            yield
+        finally:
+            with self._in_flight_lock:
+                self._in_flight[token] -= 1
+                if not self._in_flight[token]:
+                    del self._in_flight[token]
+
+    @staticmethod
+    def _unavailable(exc: Overloaded):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service overloaded",
+            headers={"Retry-After": str(exc.retry_after)})
+
+    @staticmethod
+    def _failed(exc: ServiceError):
+        return HTTPException(status_code=exc.status, detail=exc.detail)
+
+    @property
+    def file_parser(self):
+        # Imported on the first file, pandas is only loaded if needed
+        return backends.resolve('parser', self.FILE_PARSER)
+
     def _parse_file(self, input_: FileInput):
-        parser = self.FILE_PARSER()
-        items = parser.parse(input_.file)
-        yield from items
+        parser = self.file_parser()
+        items = list(parser.parse(input_.file))  # TODO consume 1 by 1
+        return items, parser.bad_lines
 
     def _create_file(self, job: TestJob):
-        filename = self.FILE_PARSER.generate_filename(prefix=self.MODEL_NAME)
-        media_type = self.FILE_PARSER.mediatype
+        parser = self.file_parser
+        filename = parser.generate_filename(prefix=self.MODEL_NAME)
+        media_type = parser.mediatype
         lines = job.results
-        with self.FILE_PARSER.build(lines=lines) as file_content:
+        with parser.build(lines=lines) as file_content:
             response = StreamingResponse(file_content,
                                          media_type=media_type)
             response.headers["Content-Disposition"] = (
                 f"attachment; filename={filename}")
         return response
 
-    def _async_predict(self, token, background_tasks: BackgroundTasks,
+    def _async_predict(self, background_tasks: BackgroundTasks,
                        job: TestJob, items: List):
         def _inner(items):
-            predict_func = self.post_predict()
             for item in items:
                 try:
                     item = self.INPUT_TYPE(**item)
                 except Exception as e:
                     logger.info(
                         f"Ommited {item} Failure during parsing: {str(e)}")
+                    continue
+                try:
+                    inference_result = self._dispatch_batch(
+                        'predict', input_=item.dict())
+                except ValueError:
+                    logger.info(f"Ommited {item} Service timeout for predict")
+                except ServiceError as exc:
+                    logger.info(f"Ommited {item} Failure in service: "
+                                f"{exc.detail}")
                 else:
-                    inference_result = predict_func(token, item)
-                    self.database.update_test_job(
-                        job=job, task=self.OUTPUT_TYPE(**inference_result))
+                    task = build(self.OUTPUT_TYPE, inference_result,
+                                 trusted=self.TRUSTED_OUTPUT)
+                    self.database.update_test_job(job=job, task=task)
 
         for i in range(0, len(items), self.BATCH_SIZE):
             background_tasks.add_task(_inner, items[i:i+self.BATCH_SIZE])
 
+    def _dispatch_batch(self, method, **kwargs):
+        # Background work waits for room in the queue instead of failing
+        while True:
+            try:
+                return self.connector.dispatch(method, lane=BATCH, **kwargs)
+            except Overloaded as exc:
+                time.sleep(exc.retry_after)
+
+    def _send_batch(self, method, **kwargs):
+        while True:
+            try:
+                return self.connector.send(method, lane=BATCH, **kwargs)
+            except Overloaded as exc:
+                time.sleep(exc.retry_after)
+
     def _async_train(self, background_tasks, job: TestJob, items: List):
         # TODO refactor this controlling threads with batch size
 
         def _inner(database, job, items):
 
             try:
-                model_version = self.connector.dispatch('train', input_=items)
+                model_version = self.connector.dispatch('train', input_=items,
+                                                        job=job.dict())
             except ValueError:
                 raise HTTPException(
                     status_code=404,
                     detail="Service timeout for train")
+            except ServiceError as exc:
+                self.database.fail_train_job(job, exc.detail)
+                return
 
-            self.database.update_train_job(job=job, version=model_version)
+            # Services training in background update the job themselves
+            if model_version is not None:
+                self.database.update_train_job(job=job, version=model_version)
 
         background_tasks.add_task(_inner, self.database, job, items)
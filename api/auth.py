@@ -1,3 +1,8 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Callable
 import jwt
@@ -22,6 +27,65 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
+class TokenCache:
+    # Verified tokens until their expiration, dropped when users reload
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str, generation: int):
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            user, expires, user_generation = entry
+            if expires <= time.time() or user_generation != generation:
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return user
+
+    def set(self, token: str, user, expires: float, generation: int):
+        with self._lock:
+            self._tokens[token] = (user, expires, generation)
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
+
+
+class LoginLimiter:
+    # Sliding window of login attempts by username
+    MAX_TRACKED = 10000
+
+    def __init__(self, attempts: int, window: float):
+        self.attempts = attempts
+        self.window = window
+        self._attempts = defaultdict(deque)
+
+    def check(self, username: str):
+        # Seconds to wait before trying again, None when allowed
+        now = time.monotonic()
+        if len(self._attempts) > self.MAX_TRACKED:
+            self._purge(now)
+        attempts = self._attempts[username]
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if len(attempts) >= self.attempts:
+            return int(attempts[0] + self.window - now) + 1
+        attempts.append(now)
+        return None
+
+    def clear(self, username: str):
+        self._attempts.pop(username, None)
+
+    def _purge(self, now: float):
+        for username in [u for u, attempts in self._attempts.items()
+                         if attempts[-1] <= now - self.window]:
+            del self._attempts[username]
+
+
 class Auth:
 
     oauth2_scheme = None
@@ -35,6 +99,18 @@ class Auth:
         with open(CONF_FILE, 'r') as file:
             self.conf = yaml.safe_load(file)
 
+        self.tokens = TokenCache()
+
+        # Password hashing runs off the event loop in a bounded pool
+        users.configure(rounds=self.conf.get('BCRYPT_ROUNDS', 12))
+        self._hash_pool = ThreadPoolExecutor(
+            max_workers=self.conf.get('HASH_WORKERS', 2))
+        self._max_pending_logins = self.conf.get('MAX_PENDING_LOGINS', 32)
+        self._pending_logins = 0
+        self.login_limiter = LoginLimiter(
+            attempts=self.conf.get('LOGIN_ATTEMPTS', 10),
+            window=self.conf.get('LOGIN_WINDOW_SECONDS', 60))
+
     def _validate_instance(self):
         assert self.oauth2_scheme is not None, ("You have to setup a"
                                                 " oauth2_scheme")
@@ -53,7 +129,7 @@ class Auth:
             algorithm=self.conf['ALGORITHM'])
         return encoded_jwt
 
-    async def get_current_user(self):
+    def get_current_user(self):
 
         async def _inner(token: Annotated[str, Depends(self.oauth2_scheme)]):
 
@@ -63,9 +139,14 @@ class Auth:
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
+            generation = users.refresh()
+            user = self.tokens.get(token, generation)
+            if user is not None:
+                return user
+
             try:
                 payload = jwt.decode(token, self.conf['SECRET_KEY'],
-                                     algorithm=self.conf['ALGORITHM'])
+                                     algorithms=[self.conf['ALGORITHM']])
                 username: str = payload.get("sub")
                 if username is None:
                     raise credentials_exception
@@ -75,11 +156,12 @@ class Auth:
             user = users.get(username=token_data.username)
             if user is None:
                 raise credentials_exception
+            self.tokens.set(token, user, payload["exp"], generation)
             return user
 
         return _inner
 
-    async def get_current_active_user(self):
+    def get_current_active_user(self):
 
         async def _inner(current_user: Annotated[
                 User, Depends(self.get_current_user())]):
@@ -110,14 +192,36 @@ class Auth:
         authenticator: Annotated[
             Callable[[str, str], UserInDB], Depends(users.authenticator)]
     ) -> Token:
-        user = authenticator(form_data.username,
-                             form_data.password)
+        retry_after = self.login_limiter.check(form_data.username)
+        if retry_after is not None:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts",
+                headers={"Retry-After": str(retry_after)},
+            )
+        if self._pending_logins >= self._max_pending_logins:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress",
+                headers={"Retry-After": "1"},
+            )
+
+        self._pending_logins += 1
+        try:
+            loop = asyncio.get_running_loop()
+            user = await loop.run_in_executor(
+                self._hash_pool, authenticator,
+                form_data.username, form_data.password)
+        finally:
+            self._pending_logins -= 1
+
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        self.login_limiter.clear(form_data.username)
         access_token_expires = timedelta(
             minutes=self.conf['ACCESS_TOKEN_EXPIRE_MINUTES'])
         access_token = self.create_access_token(
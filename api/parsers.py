@@ -1,9 +1,12 @@
+import codecs
+import csv
 import pandas as pd
+from pydantic import BaseModel
 from datetime import datetime
 from abc import abstractmethod, ABCMeta
 from contextlib import contextmanager
 from tempfile import SpooledTemporaryFile, NamedTemporaryFile
-from typing import Iterable
+from typing import Dict, Iterable, List
 
 
 def _flat_dict(pyobj, keystring=''):
@@ -11,7 +14,7 @@ def _flat_dict(pyobj, keystring=''):
         keystring = keystring + '_' if keystring else keystring
         for k in pyobj:
             yield from _flat_dict(pyobj[k], keystring + str(k))
-    elif isinstance(pyobj, list):
+    elif isinstance(pyobj, (list, tuple)):
         keystring = keystring + '_' if keystring else keystring
         for n, obj in enumerate(pyobj):
             yield from _flat_dict(obj, keystring + str(n))
@@ -19,8 +22,46 @@ def _flat_dict(pyobj, keystring=''):
         yield keystring, pyobj
 
 
+def _flat_column(values: List, name: str, columns: Dict[str, List]):
+    # Same flattening as _flat_dict, walking the schema once per column
+    # instead of once per row: nested keys and list lengths are taken from
+    # all the rows and each leaf column is filled in a single pass.
+    # Models are read through their fields, avoiding a .dict() copy per row
+    values = [v.__dict__ if isinstance(v, BaseModel) else v for v in values]
+    sample = next((v for v in values if v is not None), None)
+    prefix = name + '_' if name else name
+
+    if isinstance(sample, dict):
+        keys = dict.fromkeys(k for v in values if isinstance(v, dict)
+                             for k in v)
+        for k in keys:
+            column = [v.get(k) if isinstance(v, dict) else None
+                      for v in values]
+            _flat_column(column, prefix + str(k), columns)
+    elif isinstance(sample, (list, tuple)):
+        length = max((len(v) for v in values if isinstance(v, (list, tuple))),
+                     default=0)
+        for n in range(length):
+            column = [v[n] if isinstance(v, (list, tuple)) and len(v) > n
+                      else None for v in values]
+            _flat_column(column, prefix + str(n), columns)
+    else:
+        columns[name] = values
+
+
+def _to_dataframe(lines: Iterable) -> pd.DataFrame:
+    lines = list(lines)
+    if not lines:
+        return pd.DataFrame()
+    columns = {}
+    _flat_column(lines, '', columns)
+    return pd.DataFrame(columns)
+
+
 class FileParser(metaclass=ABCMeta):
     mediatype = None
+    # Malformed lines skipped by the last parse
+    bad_lines = 0
 
     @staticmethod
     @abstractmethod
@@ -44,16 +85,13 @@ class CSVFileParser(FileParser):
     @staticmethod
     def parse(file: SpooledTemporaryFile) -> Iterable:
         try:
-            df = pd.read_csv(file._file,
-                             warn_bad_lines=True,
-                             error_bad_lines=False)
+            df = pd.read_csv(file._file, on_bad_lines='warn')
         except UnicodeDecodeError:
             file.seek(0)
             df = pd.read_csv(file._file,
                              encoding='ISO-8859-1',
                              sep=";",
-                             warn_bad_lines=True,
-                             error_bad_lines=False)
+                             on_bad_lines='warn')
         df = df.fillna("")
         yield from df.to_dict("records")
 
@@ -61,14 +99,7 @@ class CSVFileParser(FileParser):
     @contextmanager
     def build(lines: Iterable):
         f = NamedTemporaryFile('w')
-        records = []
-
-        for index, line in enumerate(lines):
-            line = _flat_dict(line.dict())
-            line = {key: value for key, value in line}
-            records.append(line)
-
-        df = pd.DataFrame(records)
+        df = _to_dataframe(lines)
         df.to_csv(f.name)
         f.seek(0)
         yield open(f.name, mode="rb")
@@ -79,6 +110,78 @@ class CSVFileParser(FileParser):
         return f"{prefix}_output_{datetime.now()}.csv"
 
 
+class ArrowCSVFileParser(CSVFileParser):
+    # Streams CSV files as record batches with the pyarrow engine
+    # (optional dependency). The delimiter is sniffed from the header and
+    # the encoding checked over the raw bytes, instead of parsing the
+    # whole file again when it isn't UTF-8. Values are kept as text, as
+    # types inferred from the first block would fail on a later one; the
+    # service input types convert them.
+    SAMPLE_SIZE = 64 * 1024
+    BATCH_SIZE = 10000
+    DELIMITERS = ",;\t|"
+
+    def parse(self, file: SpooledTemporaryFile) -> Iterable:
+        for batch in self.parse_batches(file):
+            yield from batch
+
+    def parse_batches(self, file: SpooledTemporaryFile) -> Iterable:
+        from pyarrow import csv as pa_csv
+
+        encoding, delimiter, columns = self.sniff(file)
+
+        bad_lines = []
+
+        def skip(row):
+            bad_lines.append(row.number)
+            return 'skip'
+
+        import pyarrow as pa
+
+        reader = pa_csv.open_csv(
+            file,
+            read_options=pa_csv.ReadOptions(encoding=encoding),
+            parse_options=pa_csv.ParseOptions(delimiter=delimiter,
+                                              invalid_row_handler=skip),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pa.string() for name in columns}))
+        for block in reader:
+            self.bad_lines = len(bad_lines)
+            table = pa.Table.from_batches([block])
+            # Empty values stay "" as text, same as pandas fillna("")
+            for batch in table.to_batches(max_chunksize=self.BATCH_SIZE):
+                yield batch.to_pylist()
+        self.bad_lines = len(bad_lines)
+
+    def sniff(self, file: SpooledTemporaryFile):
+        sample = file.read(self.SAMPLE_SIZE)
+        encoding = 'utf8' if self._is_utf8(sample, file) else 'latin1'
+        file.seek(0)
+        text = sample.decode(encoding, errors='ignore')
+
+        # Most frequent candidate in the header line
+        header = text.lstrip('\ufeff').splitlines()[0] if text else ''
+        delimiter = max(self.DELIMITERS, key=header.count)
+        if not header.count(delimiter):
+            delimiter = ','
+        columns = next(csv.reader([header], delimiter=delimiter), [])
+
+        return encoding, delimiter, columns
+
+    def _is_utf8(self, sample: bytes, file: SpooledTemporaryFile) -> bool:
+        # The whole file, as pandas does: a latin1 byte anywhere would
+        # turn its column into bytes. Decoded by chunks, not kept.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            while sample:
+                decoder.decode(sample, final=False)
+                sample = file.read(self.SAMPLE_SIZE)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+
 class XLSXFileParser(FileParser):
     mediatype = (
         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
@@ -94,14 +197,7 @@ class XLSXFileParser(FileParser):
     @contextmanager
     def build(lines: Iterable):
         f = NamedTemporaryFile('w')
-        records = []
-
-        for index, line in enumerate(lines):
-            line = _flat_dict(line.dict())
-            line = {key: value for key, value in line}
-            records.append(line)
-
-        df = pd.DataFrame(records)
+        df = _to_dataframe(lines)
         df.to_excel(f.name,
                     sheet_name='Model Output',
                     engine='xlsxwriter')
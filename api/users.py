@@ -1,6 +1,8 @@
-from passlib.context import CryptContext
+import os
+import threading
+import time
 from pydantic import BaseModel
-from typing import Optional, Callable
+from typing import Optional, Callable, Dict
 import yaml
 
 USERS_FILE = "/app/users/users.yml"
@@ -18,11 +20,53 @@ class UserInDB(User):
 
 
 class Users():
+    # Seconds between checks of the users file for changes
+    RELOAD_INTERVAL = 5
 
-    def __init__(self):
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    def __init__(self, rounds: int = 12):
+        # Users file and bcrypt context are loaded on first use
+        self.configure(rounds)
+        self.users: Dict[str, UserInDB] = {}
+        # Increases on every reload, to invalidate anything derived
+        self.generation = 0
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def configure(self, rounds: int):
+        # bcrypt cost of new hashes, existing ones keep their own
+        self.rounds = rounds
+        self._pwd_context = None
+
+    @property
+    def pwd_context(self):
+        if self._pwd_context is None:
+            from passlib.context import CryptContext
+            self._pwd_context = CryptContext(
+                schemes=["bcrypt"], deprecated="auto",
+                bcrypt__rounds=self.rounds)
+        return self._pwd_context
+
+    def _load(self):
+        mtime = os.stat(USERS_FILE).st_mtime
         with open(USERS_FILE, 'r') as file:
-            self.fake_users_db = yaml.safe_load(file)
+            users_db = yaml.safe_load(file) or {}
+        self.users = {username: UserInDB(**user_dict)
+                      for username, user_dict in users_db.items()}
+        self._mtime = mtime
+        self.generation += 1
+
+    def refresh(self) -> int:
+        now = time.monotonic()
+        if self._mtime is None or (now - self._checked_at >=
+                                   self.RELOAD_INTERVAL):
+            with self._lock:
+                if self._mtime is None or (now - self._checked_at >=
+                                           self.RELOAD_INTERVAL):
+                    self._checked_at = now
+                    if os.stat(USERS_FILE).st_mtime != self._mtime:
+                        self._load()
+        return self.generation
 
     def authenticator(self) -> Callable[[str, str], Optional[UserInDB]]:
         return self._authenticate
@@ -37,9 +81,8 @@ class Users():
         return user
 
     def get(self, username: str) -> UserInDB:
-        if username in self.fake_users_db:
-            user_dict = self.fake_users_db[username]
-            return UserInDB(**user_dict)
+        self.refresh()
+        return self.users.get(username)
 
     def verify_password(self, plain_password, hashed_password):
         return self.pwd_context.verify(plain_password, hashed_password)
@@ -0,0 +1,37 @@
+from importlib import import_module
+
+# Backends by kind and name, as "module:attribute" so nothing is imported
+# until a model asks for it
+REGISTRY = {
+    'dispatcher': {
+        'redis': 'ml_sdk.communication.redis:RedisDispatcher',
+    },
+    'worker': {
+        'redis': 'ml_sdk.communication.redis:RedisWorker',
+    },
+    'database': {
+        'redis': 'ml_sdk.database.redis:RedisDatabase',
+        'mongo': 'ml_sdk.database.mongo:MongoDatabase',
+    },
+    'parser': {
+        'csv': 'ml_sdk.api.parsers:CSVFileParser',
+        'arrow_csv': 'ml_sdk.api.parsers:ArrowCSVFileParser',
+        'xlsx': 'ml_sdk.api.parsers:XLSXFileParser',
+    },
+}
+
+
+def register(kind: str, name: str, path: str):
+    REGISTRY.setdefault(kind, {})[name] = path
+
+
+def resolve(kind: str, backend):
+    # Classes are returned as they are, names are imported from the registry
+    if not isinstance(backend, str):
+        return backend
+    try:
+        path = REGISTRY[kind][backend]
+    except KeyError:
+        raise NotImplementedError(f"Unknown {kind} backend {backend}")
+    module, _, attribute = path.partition(':')
+    return getattr(import_module(module), attribute)
@@ -0,0 +1,22 @@
+import json
+import time
+from ml_sdk.loadgen import percentiles
+
+
+def report(benchmark: str, **metrics):
+    # One JSON object per line, to compare runs across commits
+    print(json.dumps({"benchmark": benchmark, **metrics}), flush=True)
+
+
+def per_call(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+__all__ = [
+    "report",
+    "per_call",
+    "percentiles",
+]
@@ -0,0 +1,16 @@
+"""Run every benchmark with small sizes, one JSON line per result.
+
+    python -m ml_sdk.benchmarks > results.jsonl
+"""
+from ml_sdk.benchmarks import dispatch, export, test_jobs, validation
+
+
+def main():
+    validation.main(10000)
+    dispatch.main(requests=50, clients=4)
+    test_jobs.main(max_rows=10000, polls=10)
+    export.main(rows=100000, file_rows=5000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Predict round trip latency through RedisDispatcher and RedisWorker, on
+fakeredis with the fake service.
+
+    python -m ml_sdk.benchmarks.dispatch [requests] [clients]
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ml_sdk.benchmarks import report, percentiles
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+def main(requests: int = 500, clients: int = 1):
+    serve_in_thread(FakeService())
+    connector = dispatcher()
+
+    def predict(n):
+        start = time.perf_counter()
+        connector.dispatch('predict', input_={'text': f"comment {n}"})
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        latencies = list(pool.map(predict, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    report("dispatch.predict",
+           requests=requests,
+           clients=clients,
+           throughput_rps=round(requests / elapsed, 1),
+           **percentiles(latencies))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
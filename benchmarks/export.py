@@ -0,0 +1,78 @@
+"""Time to flatten test job results into the export DataFrame, row by row
+(previous implementation) versus column by column, and time and peak
+memory to build the CSV and XLSX files.
+
+    python -m ml_sdk.benchmarks.export [rows] [file_rows]
+"""
+import sys
+import time
+import tracemalloc
+import pandas as pd
+from ml_sdk.api.parsers import (_flat_dict, _to_dataframe,
+                                CSVFileParser, XLSXFileParser)
+from ml_sdk.benchmarks import report
+from ml_sdk.io.output import MultiClassificationOutput
+
+
+def results(rows: int):
+    return [
+        MultiClassificationOutput.construct(
+            input={"text": f"comment {n}", "channel": "web"},
+            prediction="class_0",
+            score=0.9,
+            predictions=[{"prediction": f"class_{i}", "score": 0.1 * i}
+                         for i in range(3)],
+        )
+        for n in range(rows)
+    ]
+
+
+def row_dataframe(lines):
+    records = []
+    for line in lines:
+        line = _flat_dict(line.dict())
+        records.append({key: value for key, value in line})
+    return pd.DataFrame(records)
+
+
+def timed(func, lines):
+    start = time.perf_counter()
+    df = func(lines)
+    return time.perf_counter() - start, df
+
+
+def build_file(parser, lines):
+    tracemalloc.start()
+    start = time.perf_counter()
+    with parser.build(lines=lines) as file_content:
+        size = len(file_content.read())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def main(rows: int = 1000000, file_rows: int = 20000):
+    lines = results(file_rows)
+    for name, parser in (("csv", CSVFileParser), ("xlsx", XLSXFileParser)):
+        elapsed, peak, size = build_file(parser, lines)
+        report(f"export.{name}",
+               rows=file_rows,
+               seconds=round(elapsed, 3),
+               peak_mb=round(peak / 2 ** 20, 1),
+               file_mb=round(size / 2 ** 20, 1))
+
+    lines = results(rows)
+    before, expected = timed(row_dataframe, lines)
+    after, df = timed(_to_dataframe, lines)
+    assert list(df.columns) == list(expected.columns)
+    report("export.flatten",
+           rows=rows,
+           columns=len(df.columns),
+           row_wise_s=round(before, 3),
+           columnar_s=round(after, 3),
+           speedup=round(before / after, 2))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,49 @@
+"""Cold import time of the API and service entry points, each in a fresh
+interpreter, and which optional backends they pull in.
+
+    python -m ml_sdk.benchmarks.imports [runs]
+"""
+import json
+import os
+import subprocess
+import sys
+import ml_sdk
+from ml_sdk.benchmarks import report
+
+MODULES = ('ml_sdk.api', 'ml_sdk.api.api', 'ml_sdk.service')
+HEAVY = ('numpy', 'pandas', 'pyarrow', 'pymongo', 'redis', 'passlib',
+         'yaml')
+
+SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {heavy} if m in sys.modules]]))
+"""
+
+
+def import_time(module: str):
+    path = os.path.dirname(os.path.dirname(ml_sdk.__file__))
+    env = dict(os.environ, PYTHONPATH=path, LOGLEVEL='WARNING')
+    output = subprocess.run(
+        [sys.executable, '-c', SCRIPT.format(module=module, heavy=HEAVY)],
+        env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def main(runs: int = 5):
+    for module in MODULES:
+        times, loaded = [], []
+        for _ in range(runs):
+            elapsed, loaded = import_time(module)
+            times.append(elapsed)
+        report("imports.cold",
+               module=module,
+               runs=runs,
+               best_ms=round(min(times) * 1000, 1),
+               loaded=loaded)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,46 @@
+"""Test jobs run by the workers: rows scored per second by job size, and
+cost of polling the job status while results pile up. Runs on fakeredis
+with the fake service.
+
+    python -m ml_sdk.benchmarks.test_jobs [max_rows] [polls]
+"""
+import sys
+import time
+from ml_sdk.benchmarks import report, per_call
+from ml_sdk.communication import BATCH
+from ml_sdk.fakes import FakeService, database, dispatcher, serve_in_thread
+
+
+def run_job(db, connector, rows: int):
+    items = [{'text': f"comment {n}"} for n in range(rows)]
+    start = time.perf_counter()
+    job = db.create_test_job(total=rows)
+    db.stage_test_job(job, items)
+    connector.send('run_test_job', lane=BATCH, job=job.dict())
+    while str(job.job_id) in {j.job_id for j in db.pending_test_jobs()}:
+        time.sleep(0.01)
+    return job, time.perf_counter() - start
+
+
+def main(max_rows: int = 10000, polls: int = 20):
+    serve_in_thread(FakeService())
+    db, connector = database(), dispatcher()
+
+    rows = 100
+    while rows <= max_rows:
+        job, elapsed = run_job(db, connector, rows)
+        report("test_job.run",
+               rows=rows,
+               chunk_size=FakeService.TEST_JOB_CHUNK_SIZE,
+               seconds=round(elapsed, 3),
+               rows_per_s=round(rows / elapsed, 1))
+
+        poll = per_call(lambda: db.get_test_job(job.job_id), polls)
+        report("test_job.poll",
+               rows=rows,
+               poll_ms=round(poll * 1000, 3))
+        rows *= 10
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,65 @@
+"""Pydantic cost of one predict round trip, validating at every hop
+versus validating once at the edge.
+
+    python -m ml_sdk.benchmarks.validation [iterations]
+"""
+import sys
+from ml_sdk.benchmarks import report, per_call
+from ml_sdk.io import InferenceInput
+from ml_sdk.io.output import MultiClassificationOutput
+from ml_sdk.io.validation import build
+
+
+class CommentsInput(InferenceInput):
+    comentario_atencion: str
+    comentario_fcr: str
+    comentario_canal: str
+    comentario_ce: str
+    canal: str
+
+
+PAYLOAD = {
+    "comentario_atencion": "muy buena atencion",
+    "comentario_fcr": "resolvieron mi problema",
+    "comentario_canal": "rapido",
+    "comentario_ce": "nada mas",
+    "canal": "Chat",
+}
+
+
+def model_output(inference_input):
+    output = {
+        "predictions": [{"prediction": f"class_{i}", "score": 0.1 * i}
+                        for i in range(3)],
+        "prediction": "class_0",
+        "score": 0.9,
+        "input": inference_input.dict(),
+    }
+    return MultiClassificationOutput(**output)
+
+
+def round_trip(trusted: bool):
+    # API edge
+    input_ = CommentsInput(**PAYLOAD).dict()
+    # Service
+    input_ = CommentsInput.preprocess(input_)
+    inference_input = build(CommentsInput, input_, trusted=trusted)
+    result = model_output(inference_input).dict()
+    # API response
+    if not trusted:
+        MultiClassificationOutput(**result)
+    return result
+
+
+def main(number: int = 20000):
+    before = per_call(lambda: round_trip(trusted=False), number)
+    after = per_call(lambda: round_trip(trusted=True), number)
+    report("validation.predict_round_trip",
+           iterations=number,
+           validated_us=round(before * 1e6, 2),
+           trusted_us=round(after * 1e6, 2),
+           speedup=round(before / after, 2))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,9 +1,40 @@
+import os
+import queue
+import socket
+import threading
+import time
 import uuid
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from ml_sdk import metrics, tracing
+from ml_sdk.profiling import Profiler
 
 logger = logging.getLogger(__name__)
 
+# Priority lanes
+REALTIME = 'realtime'
+BATCH = 'batch'
+TRAIN = 'train'
+
+# Key of the replies telling the handler failed instead of a result
+ERROR = '__error__'
+
+
+class Overloaded(Exception):
+    def __init__(self, lane, retry_after=1):
+        super().__init__(f"Queue {lane} is full")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class ServiceError(Exception):
+    # Handler failure replied to the dispatcher, `status` as in HTTP
+    def __init__(self, detail, status=500):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+
 
 class ProducerInterface(ABC):
 
@@ -22,7 +53,7 @@ class ConsumerInterface(ABC):
 class ConsumerKeyInterface(ABC):
 
     @abstractmethod
-    def _consume(self, key):
+    def _consume(self, key, deadline=None):
         pass
 
 
@@ -34,56 +65,508 @@ class CriticalRegion(ABC):
 
 
 class WorkerInterface(ProducerInterface, ConsumerInterface, CriticalRegion):
+    topic = None
+    # Broadcast methods run by the worker itself, see ml_sdk.profiling
+    CONTROL_METHODS = {
+        'profile_start': 'start',
+        'profile_stop': 'stop',
+        'memory_snapshot': 'memory_snapshot',
+        'memory_stop': 'memory_stop',
+    }
+    # Profilers acting on the thread reading the queues, which starts and
+    # stops them between messages: cProfile only sees the thread enabling it
+    DATA_THREAD_PROFILERS = ('cprofile',)
+    _profiler = None
+    _handoff = None
+    # Status reported by the heartbeat and control acknowledgements
+    _status = None
+    # Micro-batching of predict messages, disabled with batch_size 1
+    batch_size = 1
+    batch_wait = 0
+    # Messages handled at the same time, in a thread pool when above 1
+    concurrency = 1
+    _executor = None
 
     def _listen(self):
+        key, kwargs = self._consume()
+        self._dequeued(kwargs)
+
+        if self._batchable(kwargs) and self.batch_size > 1:
+            batch, pending = self._gather_batch(key, kwargs)
+            # Other messages were already taken, they run in any case
+            try:
+                self._submit(self._execute_batch, batch)
+            except Exception:
+                logger.exception("Service execute predict_batch failed")
+        else:
+            pending = [(key, kwargs)]
+
+        for key, kwargs in pending:
+            # Messages without reply (test job chunks) keep their order in
+            # this thread
+            if key is None:
+                self._execute(key, kwargs)
+            else:
+                self._submit(self._execute, key, kwargs)
+
+    def _submit(self, function, *args):
+        if self.concurrency <= 1:
+            return function(*args)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency)
+            self._slots = threading.BoundedSemaphore(self.concurrency)
+
+        # Wait for a free slot, so no more than `concurrency` messages are
+        # taken from the queue and the rest stay available to other workers
+        self._slots.acquire()
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(self._release)
+
+    def _release(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            logger.error("Service execution failed",
+                         exc_info=future.exception())
+
+    def _execute(self, key, kwargs):
 
         def set_reply(key, message):
             self._produce(key, message)
 
         def execute(method, *args, **kwargs):
-            func = getattr(self.handler, method)
+            if method in self.CONTROL_METHODS:
+                func = getattr(self.profiler, self.CONTROL_METHODS[method])
+            else:
+                func = getattr(self.handler, method)
             return func(**kwargs)
 
-        key, kwargs = self._consume()
+        if self._expired(kwargs):
+            return
+
+        timings = kwargs.pop('trace', None)
+        context = kwargs.pop('trace_context', None)
+        kwargs = self._loaded(key, kwargs)
+        if kwargs is None:
+            return
+
         method = kwargs.pop('method', None)
+        reply_to = kwargs.pop('reply_to', None)
 
         logger.info(f"Service execute {method}")
-        result = execute(method, **kwargs)
+        try:
+            with tracing.span(f"execute {method}", context):
+                start = time.perf_counter()
+                self._stamp(timings, 'start')
+                result = execute(method, **kwargs)
+                self._stamp(timings, 'end')
+                metrics.observe_since(metrics.HANDLER_LATENCY, start,
+                                      self.topic, method)
+        except Exception as exc:
+            # The failure is replied and returned, a bad message must not
+            # take the worker down with it
+            if isinstance(exc, ServiceError):
+                logger.info(f"Service execute {method} refused: {exc}")
+            else:
+                logger.exception(f"Service execute {method} failed")
+            result, error = self._error_reply(exc), exc
+        else:
+            result, error = self._timed_reply(result, timings), None
 
         if key:
             set_reply(key, result)
+        # Broadcasts collecting the answer of every worker
+        if reply_to:
+            self._append(reply_to, {'worker': self.name, 'result': result})
+        return error
+
+    def _gather_batch(self, key, kwargs):
+        # Collect predict messages until the batch is full, the wait
+        # budget is spent or another kind of message comes, which is kept
+        # to run afterwards: the rest stay queued for other workers
+        batch, pending = [(key, kwargs)], []
+        deadline = time.monotonic() + self.batch_wait
+
+        while (len(batch) < self.batch_size and
+               time.monotonic() < deadline):
+            message = self._consume_nowait()
+            if message is None:
+                time.sleep(0.001)
+                continue
+
+            key, kwargs = message
+            self._dequeued(kwargs)
+            if not (key and self._batchable(kwargs)):
+                pending.append(message)
+                break
+            batch.append(message)
+
+        return batch, pending
+
+    @staticmethod
+    def _batchable(kwargs):
+        # Predicts pinned to a version run on their own
+        return kwargs.get('method') == 'predict' and 'version' not in kwargs
+
+    def _execute_batch(self, batch):
+        loaded = []
+        for key, kwargs in batch:
+            if self._expired(kwargs):
+                continue
+            timings = kwargs.pop('trace', None)
+            kwargs.pop('trace_context', None)
+            kwargs = self._loaded(key, kwargs)
+            if kwargs is not None:
+                loaded.append((key, kwargs, timings))
+        if not loaded:
+            return
+
+        logger.info(f"Service execute predict_batch of {len(loaded)}")
+        inputs = [kwargs['input_'] for _, kwargs, _ in loaded]
+        try:
+            with tracing.span("execute predict_batch", size=len(loaded)):
+                start = time.perf_counter()
+                for _, _, timings in loaded:
+                    self._stamp(timings, 'start')
+                results = self.handler.predict_batch(input_=inputs)
+                assert len(results) == len(loaded), (
+                    f"predict_batch returned {len(results)} results "
+                    f"for {len(loaded)} inputs")
+                for _, _, timings in loaded:
+                    self._stamp(timings, 'end')
+                metrics.observe_since(metrics.HANDLER_LATENCY, start,
+                                      self.topic, 'predict_batch')
+        except Exception:
+            # One by one, so only the messages failing get an error reply
+            logger.exception("Service execute predict_batch failed")
+            for key, kwargs, timings in loaded:
+                if timings is not None:
+                    kwargs['trace'] = timings
+                self._execute(key, dict(kwargs, method='predict'))
+            return
+
+        for (key, _, timings), result in zip(loaded, results):
+            if key:
+                self._produce(key, self._timed_reply(result, timings))
+
+    def _dequeued(self, kwargs):
+        sent_at = kwargs.pop('sent_at', None)
+        if sent_at is not None:
+            metrics.QUEUE_WAIT.labels(self.topic, kwargs.get('method')
+                                      ).observe(time.time() - sent_at)
+        # Traced messages collect their timestamps until the reply
+        if kwargs.get('trace'):
+            kwargs['trace'] = {'enqueue': sent_at, 'dequeue': time.time()}
+
+    @staticmethod
+    def _stamp(timings, name):
+        if timings is not None:
+            timings[name] = time.time()
+
+    @staticmethod
+    def _error_reply(exc):
+        status = exc.status if isinstance(exc, ServiceError) else 500
+        return {ERROR: {'detail': str(exc), 'status': status}}
+
+    def _timed_reply(self, result, timings):
+        if timings is None:
+            return result
+        self._stamp(timings, 'reply')
+        return {'result': result, 'timings': timings}
+
+    @staticmethod
+    def _expired(kwargs):
+        # Skip work whose caller already gave up waiting for the reply
+        deadline = kwargs.pop('deadline', None)
+        if deadline is not None and time.time() > deadline:
+            logger.info(f"Service drop expired {kwargs.get('method')}")
+            return True
+        return False
+
+    def _load_payload(self, key, kwargs):
+        # Transports offloading large payloads fetch them here, once the
+        # message is known to be worth running. Raises ServiceError when
+        # the payload is gone.
+        return kwargs
+
+    def _loaded(self, key, kwargs):
+        # None when the payload is gone, after replying the error so the
+        # caller fails instead of waiting for its timeout (train jobs)
+        method = kwargs.get('method')
+        try:
+            return self._load_payload(key, kwargs)
+        except ServiceError as exc:
+            logger.warning(f"Service drop {method}: {exc}")
+            if key:
+                self._produce(key, self._error_reply(exc))
+            return None
+
+    def reconnect(self):
+        # Transports open connections of their own for a process forked
+        # from this one, which locks and replies but doesn't consume
+        pass
+
+    def _consume_nowait(self):
+        # Transports supporting micro-batching return a pending message
+        # or None without waiting
+        return None
+
+    @property
+    def name(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def profiler(self):
+        if self._profiler is None:
+            self._profiler = Profiler()
+        return self._profiler
+
+    @abstractmethod
+    def _append(self, key, message):
+        pass
+
+    def start_control(self):
+        # Broadcasts (deploy, traffic split, profiling) are read in their
+        # own thread, so they apply while a long message runs and reading
+        # the queues never waits on them. Handlers of broadcasts run along
+        # with the ones of queued messages, see MLServiceInterface._deploy.
+        def listen():
+            while True:
+                try:
+                    message = self._consume_control()
+                except Exception:
+                    logger.exception("Control channel failed")
+                    time.sleep(1)
+                    continue
+                if message is not None:
+                    self._control(*message)
+
+        self._handoff = queue.SimpleQueue()
+        threading.Thread(target=listen, daemon=True).start()
+
+    def _control(self, key, kwargs, data_thread=False):
+        if not data_thread:
+            kwargs = self._loaded(key, kwargs)
+            if kwargs is None:
+                return
+            if self._on_data_thread(kwargs):
+                self._handoff.put((key, kwargs))
+                return
+
+        method = kwargs.get('method')
+        ack = {'control_id': kwargs.pop('control_id', None),
+               'method': method}
+        self._dequeued(kwargs)
+        try:
+            error = self._execute(key, kwargs)
+        except Exception as exc:
+            logger.exception(f"Control {method} failed")
+            error = exc
+        if error is not None:
+            ack['error'] = repr(error)
+        self._acknowledge(ack)
+
+    def _on_data_thread(self, kwargs):
+        method = kwargs.get('method')
+        if method == 'profile_start':
+            kind = kwargs.get('kind', 'sampling')
+        elif method == 'profile_stop':
+            kind = self.profiler.kind
+        else:
+            return False
+        return kind in self.DATA_THREAD_PROFILERS
+
+    def _run_handoff(self):
+        # Called by the thread reading the queues, also while idle
+        while self._handoff is not None and not self._handoff.empty():
+            key, kwargs = self._handoff.get()
+            self._control(key, kwargs, data_thread=True)
+
+    def _acknowledge(self, ack):
+        # Tell dispatchers which control message took effect, along with
+        # the worker status after it (version, see `start_heartbeat`)
+        ack['acked_at'] = time.time()
+        try:
+            if self._status is not None:
+                ack.update(self._status())
+            self._ack(ack)
+        except Exception:
+            logger.exception("Control acknowledgement failed")
+
+    @abstractmethod
+    def _consume_control(self):
+        # Next broadcast (key, kwargs), or None after a short wait
+        pass
+
+    @abstractmethod
+    def _ack(self, ack):
+        pass
+
+    def start_heartbeat(self, ttl, status):
+        # Announce this worker while it runs, with what `status()` returns
+        self._status = status
+
+        def beat():
+            while True:
+                try:
+                    self._heartbeat(ttl, status())
+                except Exception:
+                    logger.exception("Heartbeat failed")
+                time.sleep(ttl / 3)
+
+        threading.Thread(target=beat, daemon=True).start()
+
+    @abstractmethod
+    def _heartbeat(self, ttl, status):
+        pass
+
+    def enqueue(self, method, lane=REALTIME, **kwargs):
+        # Queue a message for any worker of the topic, without a reply
+        kwargs['method'] = method
+        kwargs['sent_at'] = time.time()
+        self._enqueue(kwargs, lane)
+
+    @abstractmethod
+    def _enqueue(self, message, lane=REALTIME):
+        pass
 
     def serve_forever(self):
+        self.start_control()
+        # Workers are listed with their version before any broadcast
+        self._acknowledge({'control_id': None, 'method': None})
         while True:
             self._listen()
 
 
 class DispatcherInterface(ProducerInterface, ConsumerKeyInterface):
-
-    def dispatch(self, method, **kwargs):
-
-        def get_reply(key):
-            key, result = self._consume(key)
+    topic = None
+    METHOD_LANES = {'train': TRAIN}
+    # Methods run however late they are taken, their results are stored
+    # and not only replied
+    NO_DEADLINE_METHODS = ('train',)
+    # Seconds to wait for a reply, by method
+    timeout = 10
+    timeouts = {}
+    # Seconds the acknowledgements of a stopped worker are kept
+    ack_ttl = 24 * 3600
+
+    def dispatch(self, method, lane=None, **kwargs):
+
+        def get_reply(key, deadline):
+            key, result = self._consume(key, deadline)
             return result
 
         logger.info(f"API dispatch {method}")
 
+        lane = lane or self.METHOD_LANES.get(method, REALTIME)
+        # Absolute deadline, so workers can skip requests nobody waits for
+        deadline = time.time() + self.timeouts.get(method, self.timeout)
         key = uuid.uuid4().hex
         kwargs['method'] = method
-        self._produce(key, kwargs)
-        result = get_reply(key)
+        if method not in self.NO_DEADLINE_METHODS:
+            kwargs['deadline'] = deadline
+        kwargs['sent_at'] = time.time()
+        with tracing.span(f"dispatch {method}"):
+            if tracing.enabled:
+                kwargs['trace_context'] = tracing.inject()
+            start = time.perf_counter()
+            self._produce_admitted(key, kwargs, lane)
+            try:
+                result = get_reply(key, deadline)
+            except ValueError:
+                metrics.DISPATCH_TIMEOUTS.labels(self.topic, method).inc()
+                raise
+        metrics.observe_since(metrics.DISPATCH_LATENCY, start,
+                              self.topic, method)
+        if isinstance(result, dict) and ERROR in result:
+            raise ServiceError(**result[ERROR])
         return result
 
+    def dispatch_timed(self, method, lane=None, **kwargs):
+        # Result along with the timestamps of each stage of the request,
+        # see ml_sdk.tracing.server_timing
+        kwargs['trace'] = True
+        reply = self.dispatch(method, lane, **kwargs)
+        timings = reply['timings']
+        timings['received'] = time.time()
+        return reply['result'], timings
+
+    def send(self, method, lane=None, **kwargs):
+        # Fire and forget, for work reporting its results elsewhere
+        logger.info(f"API send {method}")
+        lane = lane or self.METHOD_LANES.get(method, REALTIME)
+        kwargs['method'] = method
+        kwargs['sent_at'] = time.time()
+        self._produce_admitted(None, kwargs, lane)
+
+    def _produce_admitted(self, key, message, lane):
+        try:
+            self._produce(key, message, lane)
+        except Overloaded:
+            metrics.DISPATCH_REJECTED.labels(self.topic, lane).inc()
+            raise
+
+    @abstractmethod
+    def _produce(self, key, message, lane=REALTIME):
+        pass
+
+    @abstractmethod
+    def queue_depth(self):
+        pass
+
+    @abstractmethod
+    def ready_workers(self):
+        pass
+
     def broadcast(self, method, **kwargs):
+        # Returns the id workers acknowledge it with, see `workers`
         kwargs['method'] = method
-        return self._broadcast(kwargs)
+        kwargs['sent_at'] = time.time()
+        kwargs['control_id'] = uuid.uuid4().hex
+        self._broadcast(kwargs)
+        return kwargs['control_id']
+
+    def workers(self):
+        # Last control message acknowledged by each worker, with the
+        # version it runs since and whether it's still alive
+        ready = self.ready_workers()
+        acks = self._acks()
+        gone = [name for name, ack in acks.items() if name not in ready and
+                time.time() - ack['acked_at'] > self.ack_ttl]
+        if gone:
+            self._forget(gone)
+        return {name: dict(ack, ready=name in ready)
+                for name, ack in acks.items() if name not in gone}
+
+    @abstractmethod
+    def _acks(self):
+        pass
+
+    @abstractmethod
+    def _forget(self, names):
+        pass
+
+    def collect(self, method, wait=1, **kwargs):
+        # Broadcast and gather what every worker answered within `wait`
+        reply_to = uuid.uuid4().hex
+        self.broadcast(method, reply_to=reply_to, **kwargs)
+        time.sleep(wait)
+        return self._collect(reply_to)
 
     @abstractmethod
     def _broadcast(self, message):
         pass
 
+    @abstractmethod
+    def _collect(self, key):
+        pass
+
 
 __all__ = [
     "WorkerInterface",
     "DispatcherInterface",
+    "Overloaded",
+    "REALTIME",
+    "BATCH",
+    "TRAIN",
 ]
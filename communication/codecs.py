@@ -0,0 +1,193 @@
+import struct
+import sys
+from abc import ABC, abstractmethod
+import msgpack
+
+
+# Frames from codecs other than plain msgpack start with TAG, a byte
+# msgpack never produces, followed by the codec id. Untagged frames are
+# plain msgpack, so nodes with different codecs can talk to each other
+# and to older versions as long as the sender uses msgpack.
+TAG = 0xc1
+
+# msgpack extension types
+NDARRAY_EXT = 1
+
+
+def _pack_ext(obj):
+    # numpy is not imported here: arrays only exist once someone did
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("Can not serialize object arrays")
+        dtype = obj.dtype.str.encode()
+        header = struct.pack(f'<B{len(dtype)}sB{obj.ndim}Q',
+                             len(dtype), dtype, obj.ndim, *obj.shape)
+        return msgpack.ExtType(
+            NDARRAY_EXT, header + np.ascontiguousarray(obj).tobytes())
+    raise TypeError(f"Can not serialize {type(obj)}")
+
+
+def _unpack_ext(code, data):
+    if code == NDARRAY_EXT:
+        try:
+            import numpy as np
+        except ImportError:
+            raise TypeError("numpy is required to deserialize arrays")
+        # Header: dtype length, dtype, ndim, shape; then the raw buffer
+        dtype_len = data[0]
+        dtype = data[1:1 + dtype_len].decode()
+        ndim = data[1 + dtype_len]
+        offset = 2 + dtype_len
+        shape = struct.unpack_from(f'<{ndim}Q', data, offset)
+        offset += 8 * ndim
+        # Read-only view over the message, no copy
+        array = np.frombuffer(memoryview(data)[offset:], dtype=dtype)
+        return array.reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+class Codec(ABC):
+    id = None
+
+    @abstractmethod
+    def encode(self, msg) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode_payload(self, payload):
+        pass
+
+    def _frame(self, payload: bytes) -> bytes:
+        return bytes((TAG, self.id)) + payload
+
+
+class MsgpackCodec(Codec):
+    id = 0
+
+    def encode(self, msg) -> bytes:
+        return msgpack.packb(msg, use_bin_type=True, default=_pack_ext)
+
+    def decode_payload(self, payload):
+        return msgpack.unpackb(payload, use_list=False, raw=False,
+                               ext_hook=_unpack_ext)
+
+
+class OrjsonCodec(Codec):
+    id = 1
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def encode(self, msg) -> bytes:
+        return self._frame(self.orjson.dumps(
+            msg, option=self.orjson.OPT_SERIALIZE_NUMPY))
+
+    def decode_payload(self, payload):
+        return self.orjson.loads(payload)
+
+
+class CompressedCodec(Codec):
+    # Compresses frames of another codec above a size threshold
+
+    def __init__(self, codec: Codec, threshold: int = 1024):
+        self.codec = codec
+        self.threshold = threshold
+
+    def encode(self, msg) -> bytes:
+        data = self.codec.encode(msg)
+        if len(data) < self.threshold:
+            return data
+        return self._frame(self.compress(data))
+
+    def decode_payload(self, payload):
+        return decode(self.decompress(payload))
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, payload) -> bytes:
+        pass
+
+
+class LZ4Codec(CompressedCodec):
+    id = 2
+
+    def __init__(self, codec: Codec, threshold: int = 1024):
+        super().__init__(codec, threshold)
+        import lz4.frame
+        self.lz4 = lz4.frame
+
+    def compress(self, data: bytes) -> bytes:
+        return self.lz4.compress(data)
+
+    def decompress(self, payload) -> bytes:
+        return self.lz4.decompress(payload)
+
+
+class ZstdCodec(CompressedCodec):
+    id = 3
+
+    def __init__(self, codec: Codec, threshold: int = 1024):
+        super().__init__(codec, threshold)
+        import zstandard
+        self.compressor = zstandard.ZstdCompressor()
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, payload) -> bytes:
+        return self.decompressor.decompress(payload)
+
+
+CODECS = {
+    'msgpack': MsgpackCodec,
+    'orjson': OrjsonCodec,
+}
+
+COMPRESSORS = {
+    'lz4': LZ4Codec,
+    'zstd': ZstdCodec,
+}
+
+_DECODERS = {}
+
+
+def register_codec(name: str, codec_type, compressor: bool = False):
+    registry = COMPRESSORS if compressor else CODECS
+    registry[name] = codec_type
+
+
+def get_codec(name: str = 'msgpack', compress_threshold: int = 1024) -> Codec:
+    # Names are a codec optionally followed by a compressor,
+    # e.g. 'msgpack', 'orjson', 'msgpack+lz4' or 'msgpack+zstd'
+    codec_name, _, compressor = name.partition('+')
+    codec = CODECS[codec_name]()
+    if compressor:
+        codec = COMPRESSORS[compressor](codec, threshold=compress_threshold)
+    return codec
+
+
+def _decoder(codec_id: int) -> Codec:
+    if codec_id not in _DECODERS:
+        for codec_type in CODECS.values():
+            if codec_type.id == codec_id:
+                _DECODERS[codec_id] = codec_type()
+        for codec_type in COMPRESSORS.values():
+            if codec_type.id == codec_id:
+                _DECODERS[codec_id] = codec_type(CODECS['msgpack']())
+    return _DECODERS[codec_id]
+
+
+_MSGPACK = MsgpackCodec()
+
+
+def decode(data):
+    # Any node decodes any registered codec, whatever its own setting
+    if data[0] != TAG:
+        return _MSGPACK.decode_payload(data)
+    return _decoder(data[1]).decode_payload(memoryview(data)[2:])
@@ -1,9 +1,16 @@
-import msgpack
 import logging
+import math
 import redis
-from dataclasses import dataclass
+import time
+from ml_sdk import metrics
+import uuid
+from dataclasses import dataclass, field
 from retry import retry
-from ml_sdk.communication import DispatcherInterface, WorkerInterface
+from ml_sdk.communication import (DispatcherInterface, WorkerInterface,
+                                  Overloaded, ServiceError,
+                                  REALTIME, BATCH, TRAIN)
+from ml_sdk.communication.codecs import get_codec, decode
+from ml_sdk.communication.sharding import HashRing
 
 
 logger = logging.getLogger(__name__)
@@ -15,62 +22,294 @@ class RedisSettings:
     host: str = 'redis'
     port: int = 6379
     db: int = 0
+    # Lanes drained first to last while they have messages
+    strict_lanes: tuple = (REALTIME,)
+    # Remaining lanes share the leftover capacity by weight
+    lane_weights: dict = field(
+        default_factory=lambda: {BATCH: 3, TRAIN: 1})
+    # Admission control: messages a lane may hold before rejecting new ones
+    max_queue_depth: int = None
+    retry_after: int = 1
+    # Worker micro-batching of predict messages
+    batch_size: int = 1
+    batch_wait_ms: int = 0
+    # Messages a worker handles at the same time
+    concurrency: int = 1
+    # Seconds a dispatcher waits for replies, overridable by method
+    timeout: float = 10
+    timeouts: dict = field(default_factory=dict)
+    # Seconds a reply is kept when nobody reads it
+    reply_ttl: int = 60
+    # Control channel: seconds between checks of its idle connection, and
+    # seconds the acknowledgements of a stopped worker are kept
+    control_health_check: int = 30
+    ack_ttl: int = 24 * 3600
+    # Claim check: messages above this size (bytes) travel by reference,
+    # their payloads kept at least `claim_check_ttl` seconds
+    claim_check_threshold: int = None
+    claim_check_ttl: int = 300
+    # Serialization, see ml_sdk.communication.codecs.get_codec
+    codec: str = 'msgpack'
+    compress_threshold: int = 1024
+    # Sharding over several Redis, as "host:port" (host/port when empty).
+    # The first one is the control node for broadcasts and locks.
+    nodes: list = None
+    # Indexes in `nodes` a worker consumes from, all of them by default
+    shards: tuple = None
 
     @property
     def conf(self):
         return dict(host=self.host, db=self.db, port=self.port)
 
+    @property
+    def node_confs(self):
+        if not self.nodes:
+            return [self.conf]
+        confs = []
+        for node in self.nodes:
+            host, _, port = node.partition(':')
+            confs.append(dict(host=host, db=self.db,
+                              port=int(port or self.port)))
+        return confs
+
+    @property
+    def node_names(self):
+        return [f"{c['host']}:{c['port']}/{c['db']}" for c in self.node_confs]
+
 
 class RedisNode:
+    # Fields kept in the queue when the payload travels by reference
+    ENVELOPE = ('key', 'method', 'deadline', 'sent_at',
+                'trace', 'trace_context', 'version', 'control_id')
+
     def __init__(self, settings: RedisSettings):
         self.topic = settings.topic
-        redis_pool = redis.ConnectionPool(**settings.conf)
-        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.strict_lanes = tuple(settings.strict_lanes)
+        self.lane_weights = dict(settings.lane_weights)
+        self.claim_check_threshold = settings.claim_check_threshold
+        self.claim_check_ttl = settings.claim_check_ttl
+        self.codec = get_codec(settings.codec, settings.compress_threshold)
+        self.node_confs = settings.node_confs
+        self.nodes = [self._connect(conf) for conf in self.node_confs]
+        self.ring = HashRing(settings.node_names)
+        # Control node
+        self.redis = self.nodes[0]
 
     @staticmethod
-    def _decode(msg):
-        return msgpack.unpackb(msg, use_list=False, raw=False)
+    def _connect(conf: dict):
+        redis_pool = redis.ConnectionPool(**conf)
+        return redis.StrictRedis(connection_pool=redis_pool)
 
-    @staticmethod
-    def _encode(msg):
-        return msgpack.packb(msg, use_bin_type=True)
+    def reconnect(self):
+        self.nodes = [self._connect(conf) for conf in self.node_confs]
+        self.redis = self.nodes[0]
+
+    @property
+    def workers_key(self):
+        return f"{self.topic}:workers"
+
+    def _node(self, key):
+        # Queued messages, their payloads and replies by consistent hashing
+        return self.nodes[self.ring.index(key)]
+
+    @property
+    def lanes(self):
+        return self.strict_lanes + tuple(self.lane_weights)
+
+    def _lane_key(self, lane):
+        # Realtime lane keeps the plain topic for older dispatchers/workers
+        if lane == REALTIME:
+            return self.topic
+        return f"{self.topic}:{lane}"
+
+    def _pack(self, message):
+        # Large payloads are stored once in their own key and only a
+        # reference travels through the queue, keeping it small and fast.
+        # Returns the data to queue and the reference, if any.
+        data = self._encode(message)
+        if (self.claim_check_threshold is None or
+                len(data) <= self.claim_check_threshold):
+            return data, None
+
+        name = message['key'] or uuid.uuid4().hex
+        reference = f"{self.topic}:payload:{name}"
+        self._node(reference).set(reference, data,
+                                  ex=self._payload_ttl(message))
+        envelope = {k: message[k] for k in self.ENVELOPE if k in message}
+        envelope['claim_check'] = reference
+        return self._encode(envelope), reference
+
+    def _payload_ttl(self, message):
+        # Payloads live as long as their message may still run: broadcasts
+        # are left to expire, messages without deadline (train, send) are
+        # deleted by the worker taking them
+        if 'control_id' in message:
+            return self.claim_check_ttl
+        deadline = message.get('deadline')
+        if deadline is None:
+            return None
+        return max(self.claim_check_ttl, math.ceil(deadline - time.time()))
+
+    def _decode(self, msg):
+        start = time.perf_counter()
+        msg = decode(msg)
+        metrics.observe_since(metrics.CODEC_LATENCY, start,
+                              self.topic, 'decode')
+        return msg
+
+    def _encode(self, msg):
+        start = time.perf_counter()
+        msg = self.codec.encode(msg)
+        metrics.observe_since(metrics.CODEC_LATENCY, start,
+                              self.topic, 'encode')
+        return msg
 
 
 class RedisWorker(RedisNode, WorkerInterface):
     def __init__(self, settings: RedisSettings, handler):
         super(RedisWorker, self).__init__(settings)
         self.handler = handler
-        self.pubsub = self.redis.pubsub()
-        self.pubsub.psubscribe(f'{self.topic}*')
-        self.pubsub.get_message()
+        # Broadcasts come through their own connection, read by the control
+        # thread, so a busy worker neither delays them nor lets them pile up
+        self.control = self._connect(dict(
+            settings.node_confs[0],
+            health_check_interval=settings.control_health_check))
+        self.pubsub = self.control.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.topic)
 
         self.lock = self.redis.lock(f"lock: {self.topic}")
+        self._lane_credits = {lane: 0 for lane in self.lane_weights}
+        if settings.shards is None:
+            self.shards = list(self.nodes)
+        else:
+            self.shards = [self.nodes[i] for i in settings.shards]
+        self._next_shard = 0
+
+        self.batch_size = settings.batch_size
+        self.batch_wait = settings.batch_wait_ms / 1000
+        self.concurrency = settings.concurrency
+        self.reply_ttl = settings.reply_ttl
+
+    def reconnect(self):
+        super().reconnect()
+        self.lock = self.redis.lock(f"lock: {self.topic}")
 
     def _produce(self, key, message):
-        self.redis.set(key, self._encode(message))
+        self._node(key).set(key, self._encode(message), ex=self.reply_ttl)
 
-    def _consume(self):
+    def _append(self, key, message):
+        with self._node(key).pipeline() as pipe:
+            pipe.rpush(key, self._encode(message))
+            pipe.expire(key, self.reply_ttl)
+            pipe.execute()
 
-        @retry(ValueError, delay=0.5, logger=None)
-        def cons():
+    def _ack(self, ack):
+        self.redis.hset(self.workers_key, self.name, self._encode(ack))
 
-            # Read broadcasted messages
-            message = self.pubsub.get_message()
-            if message is not None and message['type'] == 'pmessage':
-                return message['data']
+    def _heartbeat(self, ttl, status):
+        self.redis.set(f"{self.topic}:ready:{self.name}",
+                       self._encode(status), ex=ttl)
 
-            # Read individual messages
-            message = self.redis.lpop(self.topic)
-            if message is not None:
-                return message
+    def _enqueue(self, message, lane=REALTIME):
+        message['key'] = None
+        node = self._node(uuid.uuid4().hex)
+        data, _ = self._pack(message)
+        node.rpush(self._lane_key(lane), data)
 
-            raise ValueError()
+    def _consume(self):
 
-        message = self._decode(cons())
+        @retry(ValueError, delay=0.5, logger=None)
+        def cons():
+            self._run_handoff()
+            message = self._poll()
+            if message is None:
+                raise ValueError()
+            return message
+
+        return self._unpack(cons())
+
+    def _consume_nowait(self):
+        message = self._poll()
+        if message is None:
+            return None
+        return self._unpack(message)
+
+    def _consume_control(self):
+        # The connection is checked and subscribed again by redis-py when
+        # it was lost, broadcasts sent meanwhile are missed
+        message = self.pubsub.get_message(timeout=1)
+        if message is None or message['type'] != 'message':
+            return None
+        return self._unpack(message['data'])
+
+    def _poll(self):
+        # Read individual messages by lane priority, from every shard
+        shards = self._shard_order()
+        for lane in self.strict_lanes:
+            for node in shards:
+                message = node.lpop(self._lane_key(lane))
+                if message is not None:
+                    return message
+
+        for lane in self._weighted_lanes():
+            for node in shards:
+                message = node.lpop(self._lane_key(lane))
+                if message is not None:
+                    self._charge_lane(lane)
+                    return message
+
+        return None
+
+    def _shard_order(self):
+        # Start from a different shard each time, so none of them waits
+        # behind the others
+        if len(self.shards) == 1:
+            return self.shards
+        self._next_shard = (self._next_shard + 1) % len(self.shards)
+        return (self.shards[self._next_shard:] +
+                self.shards[:self._next_shard])
+
+    def _unpack(self, message):
+        message = self._decode(message)
         key = message.pop('key')
 
         return key, message
 
+    def _load_payload(self, key, kwargs):
+        reference = kwargs.pop('claim_check', None)
+        if reference is None:
+            return kwargs
+
+        # Broadcast payloads are read by every worker and left to expire
+        node = self._node(reference)
+        if 'control_id' in kwargs:
+            data = node.get(reference)
+        else:
+            data = node.getdel(reference)
+        if data is None:
+            raise ServiceError(f"Payload {reference} expired before running",
+                               status=410)
+
+        # Envelope fields were already handled from the queued message
+        message = self._decode(data)
+        for name in self.ENVELOPE:
+            message.pop(name, None)
+        message.update(kwargs)
+        return message
+
+    # Smooth weighted round robin among non strict lanes, so each one gets
+    # its share of the worker when all of them have messages
+    def _weighted_lanes(self):
+        return sorted(self.lane_weights,
+                      key=lambda lane: (self._lane_credits[lane]
+                                        + self.lane_weights[lane]),
+                      reverse=True)
+
+    def _charge_lane(self, lane):
+        for name, weight in self.lane_weights.items():
+            self._lane_credits[name] += weight
+        self._lane_credits[lane] -= sum(self.lane_weights.values())
+
     def exec_critical(self, function, *args):
         logger.info("Enter critical section")
         self.lock.acquire(blocking=True)
@@ -82,32 +321,97 @@ class RedisWorker(RedisNode, WorkerInterface):
 
 
 class RedisDispatcher(RedisNode, DispatcherInterface):
+    # Push only while the lane is under the limit, in one round trip
+    BOUNDED_PUSH = """
+        if redis.call('llen', KEYS[1]) >= tonumber(ARGV[2]) then
+            return -1
+        end
+        return redis.call('rpush', KEYS[1], ARGV[1])
+    """
 
-    def _produce(self, key, message):
+    def __init__(self, settings: RedisSettings):
+        super(RedisDispatcher, self).__init__(settings)
+        self.max_queue_depth = settings.max_queue_depth
+        if self.max_queue_depth is not None:
+            # The limit is split among the shards of each lane
+            self.max_queue_depth = -(-self.max_queue_depth // len(self.nodes))
+        self.retry_after = settings.retry_after
+        self.timeout = settings.timeout
+        self.timeouts = dict(settings.timeouts)
+        self.ack_ttl = settings.ack_ttl
+        self.bounded_push = self.redis.register_script(self.BOUNDED_PUSH)
+
+    def _produce(self, key, message, lane=REALTIME):
         message['key'] = key
-        self.redis.rpush(self.topic, self._encode(message))
-
-    def _consume(self, key):
-
-        @retry(ValueError, delay=0.1, backoff=2, max_delay=1,
-               tries=15, logger=logger)
-        def get(key):
-
-            message = self.redis.getdel(key)
-
-            if message is None:
-                raise ValueError()
-
-            message = self._decode(message)
-            return message
-
+        lane_key = self._lane_key(lane)
+        node = self._node(key or uuid.uuid4().hex)
+        message, reference = self._pack(message)
+
+        if self.max_queue_depth is None:
+            node.rpush(lane_key, message)
+        elif self.bounded_push(keys=[lane_key],
+                               args=[message, self.max_queue_depth],
+                               client=node) < 0:
+            # Rejected payloads would otherwise wait for their ttl
+            if reference is not None:
+                self._node(reference).delete(reference)
+            raise Overloaded(lane, retry_after=self.retry_after)
+
+    def queue_depth(self):
+        depths = [0] * len(self.lanes)
+        for node in self.nodes:
+            with node.pipeline(transaction=False) as pipe:
+                for lane in self.lanes:
+                    pipe.llen(self._lane_key(lane))
+                depths = [a + b for a, b in zip(depths, pipe.execute())]
+        for lane, depth in zip(self.lanes, depths):
+            metrics.QUEUE_DEPTH.labels(self.topic, lane).set(depth)
+        return dict(zip(self.lanes, depths))
+
+    def ready_workers(self):
+        prefix = f"{self.topic}:ready:"
+        keys = list(self.redis.scan_iter(match=f"{prefix}*"))
+        if not keys:
+            return {}
+        return {key.decode()[len(prefix):]: self._decode(status)
+                for key, status in zip(keys, self.redis.mget(keys))
+                if status is not None}
+
+    def _acks(self):
+        return {name.decode(): self._decode(ack) for name, ack
+                in self.redis.hgetall(self.workers_key).items()}
+
+    def _forget(self, names):
+        self.redis.hdel(self.workers_key, *names)
+
+    def _consume(self, key, deadline=None):
+        if deadline is None:
+            deadline = time.time() + self.timeout
+
+        node = self._node(key)
+        delay = 0.1
         try:
-            message = get(key)
+            while True:
+                message = node.getdel(key)
+                if message is not None:
+                    return key, self._decode(message)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ValueError(f"Timeout waiting for reply {key}")
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 1)
         finally:
-            self.redis.delete(key)
-
-        return key, message
+            node.delete(key)
 
     def _broadcast(self, message):
         message['key'] = None
-        self.redis.publish(self.topic, self._encode(message))
+        data, _ = self._pack(message)
+        self.redis.publish(self.topic, data)
+
+    def _collect(self, key):
+        with self._node(key).pipeline() as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            messages, _ = pipe.execute()
+        return [self._decode(message) for message in messages]
@@ -0,0 +1,27 @@
+import bisect
+import hashlib
+from typing import List
+
+
+class HashRing:
+    # Consistent hashing of keys to nodes: adding a node only moves the
+    # keys that land on its points of the ring. Nodes are placed by name,
+    # so their order in the settings doesn't matter.
+    def __init__(self, names: List[str], replicas: int = 64):
+        self.size = len(names)
+        points = sorted((self._hash(f"{name}#{replica}"), index)
+                        for index, name in enumerate(names)
+                        for replica in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def index(self, key) -> int:
+        # Position in `names` of the node holding `key`
+        if self.size == 1:
+            return 0
+        i = bisect.bisect(self._hashes, self._hash(str(key)))
+        return self._indexes[i % len(self._indexes)]
@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod
+from typing import Dict, List
 from ml_sdk.io import TestJob, TrainJob, JobID, InferenceOutput
 
 
@@ -8,13 +9,47 @@ class DatabaseInterface(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def create_test_job(self, total: int) -> TestJob:
+    def create_test_job(self, total: int, bad_lines: int = 0) -> TestJob:
         pass
 
     @abstractmethod
     def update_test_job(self, job: TestJob, task: InferenceOutput):
         pass
 
+    # Test jobs run by the service workers: the API stages the rows and the
+    # workers score them in chunks, moving a checkpoint after each one
+    @abstractmethod
+    def stage_test_job(self, job: TestJob, items: List[Dict]):
+        pass
+
+    @abstractmethod
+    def get_test_items(self, job: TestJob, start: int, stop: int
+                       ) -> List[Dict]:
+        pass
+
+    @abstractmethod
+    def get_test_checkpoint(self, job: TestJob) -> int:
+        pass
+
+    @abstractmethod
+    def advance_test_checkpoint(self, job: TestJob, offset: int,
+                                new_offset: int) -> bool:
+        pass
+
+    @abstractmethod
+    def update_test_job_batch(self, job: TestJob,
+                              tasks: Dict[int, InferenceOutput],
+                              failed: List[int] = ()):
+        pass
+
+    @abstractmethod
+    def finish_test_job(self, job: TestJob):
+        pass
+
+    @abstractmethod
+    def pending_test_jobs(self) -> List[TestJob]:
+        pass
+
     @abstractmethod
     def get_train_job(self, job_id: JobID) -> TrainJob:
         pass
@@ -26,3 +61,11 @@ class DatabaseInterface(metaclass=ABCMeta):
     @abstractmethod
     def update_train_job(self, job: TrainJob, task: InferenceOutput):
         pass
+
+    @abstractmethod
+    def update_train_progress(self, job: TrainJob, processed: int):
+        pass
+
+    @abstractmethod
+    def fail_train_job(self, job: TrainJob, error: str):
+        pass
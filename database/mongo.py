@@ -3,6 +3,8 @@ import uuid
 import pymongo
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Dict, List
+from ml_sdk import metrics
 from ml_sdk.database import DatabaseInterface
 from ml_sdk.io import TestJob, TrainJob, JobID, InferenceOutput, ModelVersion
 
@@ -27,9 +29,14 @@ class MongoSettings:
 
 class MongoDatabase(DatabaseInterface):
     def __init__(self, settings: MongoSettings):
-        self.mongo = pymongo.MongoClient(settings.url)[settings.db]
+        self.mongo = self._connect(settings)[settings.db]
         self.mongo_jobs = self.mongo['jobs']
         self.mongo_tasks = self.mongo['tasks']
+        self.mongo_items = self.mongo['items']
+
+    @staticmethod
+    def _connect(settings: MongoSettings):
+        return pymongo.MongoClient(settings.url)
 
     def get_test_job(self, job_id: JobID) -> TestJob:
         filter_ = {'job_id': job_id}
@@ -39,25 +46,88 @@ class MongoDatabase(DatabaseInterface):
         job.processed = self.mongo_tasks.count_documents(filter_)
         return job
 
-    def create_test_job(self, total: int) -> TestJob:
+    @metrics.database_write
+    def create_test_job(self, total: int, bad_lines: int = 0) -> TestJob:
         job_id = uuid.uuid4()
         job = TestJob(
             job_id=JobID(job_id),
             total=total,
+            bad_lines=bad_lines,
             started_at=str(datetime.now())
         )
         self.mongo_jobs.insert_one(job.dict())
         return job
 
+    @metrics.database_write
     def update_test_job(self, job: TestJob, task: InferenceOutput):
         task.job_id = job.job_id
         self.mongo_tasks.insert_one(task.dict())
 
+    @metrics.database_write
+    def stage_test_job(self, job: TestJob, items: List[Dict]):
+        if items:
+            self.mongo_items.insert_many(
+                [{'job_id': job.job_id, 'index': n, 'item': item}
+                 for n, item in enumerate(items)])
+        filter_ = {'job_id': job.job_id}
+        self.mongo_jobs.update_one(
+            filter_, {'$set': {'checkpoint': 0, 'staged': True}})
+
+    def get_test_items(self, job: TestJob, start: int, stop: int
+                       ) -> List[Dict]:
+        filter_ = {'job_id': job.job_id, 'index': {'$gte': start, '$lt': stop}}
+        items = self.mongo_items.find(filter_).sort('index')
+        return [item['item'] for item in items]
+
+    def get_test_checkpoint(self, job: TestJob) -> int:
+        job = self.mongo_jobs.find_one({'job_id': job.job_id})
+        return job.get('checkpoint', 0)
+
+    @metrics.database_write
+    def advance_test_checkpoint(self, job: TestJob, offset: int,
+                                new_offset: int) -> bool:
+        # Move the checkpoint only from the offset the caller started with
+        filter_ = {'job_id': job.job_id, 'checkpoint': offset}
+        result = self.mongo_jobs.update_one(
+            filter_, {'$set': {'checkpoint': new_offset}})
+        return result.modified_count == 1
+
+    @metrics.database_write
+    def update_test_job_batch(self, job: TestJob,
+                              tasks: Dict[int, InferenceOutput],
+                              failed: List[int] = ()):
+        # Results are keyed by row, so a chunk run twice writes them once
+        if failed:
+            self.mongo_jobs.update_one(
+                {'job_id': job.job_id},
+                {'$addToSet': {'failed': {'$each': list(failed)}}})
+        requests = []
+        for index, task in tasks.items():
+            task.job_id = job.job_id
+            filter_ = {'job_id': job.job_id, 'index': index}
+            requests.append(pymongo.ReplaceOne(
+                filter_, dict(task.dict(), index=index), upsert=True))
+        if requests:
+            self.mongo_tasks.bulk_write(requests, ordered=False)
+
+    @metrics.database_write
+    def finish_test_job(self, job: TestJob):
+        filter_ = {'job_id': job.job_id}
+        self.mongo_jobs.update_one(
+            filter_, {'$set': {'end_at': str(datetime.now()),
+                               'staged': False}})
+        self.mongo_items.delete_many(filter_)
+
+    def pending_test_jobs(self) -> List[TestJob]:
+        jobs = self.mongo_jobs.find({'staged': True})
+        return [TestJob(**job) for job in jobs]
+
     def get_train_job(self, job_id: JobID) -> TrainJob:
         filter_ = {'job_id': job_id}
         job = self.mongo_jobs.find_one(filter_)
         return TrainJob(**job)
 
+    @metrics.database_write
     def create_train_job(self) -> TrainJob:
         job_id = uuid.uuid4()
         job = TrainJob(
@@ -68,9 +138,21 @@ class MongoDatabase(DatabaseInterface):
         self.mongo_jobs.insert_one(dict(job))
         return job
 
+    @metrics.database_write
     def update_train_job(self, job: TrainJob, version: ModelVersion):
         job.processed = job.total
         job.version = version
         job.end_at = str(datetime.now())
         filter_ = {"job_id": job.job_id}
         self.mongo_jobs.update_one(filter_, {"$set": dict(job)})
+
+    @metrics.database_write
+    def update_train_progress(self, job: TrainJob, processed: int):
+        filter_ = {"job_id": job.job_id}
+        self.mongo_jobs.update_one(filter_, {"$set": {"processed": processed}})
+
+    @metrics.database_write
+    def fail_train_job(self, job: TrainJob, error: str):
+        filter_ = {"job_id": job.job_id}
+        self.mongo_jobs.update_one(
+            filter_, {"$set": {"error": error, "end_at": str(datetime.now())}})
@@ -1,9 +1,12 @@
-import msgpack
 import logging
 import redis
 import uuid
 from datetime import datetime
+from typing import Dict, List
+from ml_sdk.communication.codecs import get_codec, decode
 from ml_sdk.communication.redis import RedisSettings
+from ml_sdk.communication.sharding import HashRing
+from ml_sdk import metrics
 from ml_sdk.database import DatabaseInterface
 from ml_sdk.io import TestJob, TrainJob, JobID, InferenceOutput, ModelVersion
 
@@ -12,46 +15,141 @@ logger = logging.getLogger(__name__)
 
 
 class RedisDatabase(DatabaseInterface):
+    # Move the checkpoint only from the offset the caller started with
+    ADVANCE_CHECKPOINT = """
+        if tonumber(redis.call('get', KEYS[1]) or '0') ~= tonumber(ARGV[1])
+        then
+            return 0
+        end
+        redis.call('set', KEYS[1], ARGV[2])
+        return 1
+    """
+    STAGE_CHUNK = 1000
+
     def __init__(self, settings: RedisSettings):
         self.topic = settings.topic
-        redis_pool = redis.ConnectionPool(**settings.conf)
-        self.redis = redis.StrictRedis(connection_pool=redis_pool)
+        self.codec = get_codec(settings.codec, settings.compress_threshold)
+        self.nodes = [self._connect(conf) for conf in settings.node_confs]
+        self.ring = HashRing(settings.node_names)
+        # Control node, jobs and their results are sharded by job id
+        self.redis = self.nodes[0]
+        self.advance_checkpoint = self.redis.register_script(
+            self.ADVANCE_CHECKPOINT)
 
     @staticmethod
-    def _decode(msg):
-        return msgpack.unpackb(msg, use_list=False, raw=False)
+    def _connect(conf: dict):
+        redis_pool = redis.ConnectionPool(**conf)
+        return redis.StrictRedis(connection_pool=redis_pool)
+
+    def _node(self, job_id):
+        return self.nodes[self.ring.index(job_id)]
 
     @staticmethod
-    def _encode(msg):
-        return msgpack.packb(msg, use_bin_type=True)
+    def _decode(msg):
+        return decode(msg)
+
+    def _encode(self, msg):
+        return self.codec.encode(msg)
 
     def get_test_job(self, job_id: JobID) -> TestJob:
-        job = self._decode(self.redis.get(job_id))
+        node = self._node(job_id)
+        job = self._decode(node.get(job_id))
         job = TestJob(**job)
-        processed_keys = self.redis.keys(f"{self.topic}_{job_id}_*")
-        results = self.redis.mget(processed_keys)
+        processed_keys = node.keys(f"{self.topic}_{job_id}_*")
+        results = node.mget(processed_keys)
         job.results = [self._decode(r) for r in results]
         job.processed = len(results)
+        job.failed = sorted(int(index) for index in
+                            node.smembers(f"{self.topic}:failed:{job_id}"))
         return job
 
-    def create_test_job(self, total: int) -> TestJob:
+    @metrics.database_write
+    def create_test_job(self, total: int, bad_lines: int = 0) -> TestJob:
         job_id = uuid.uuid4()
         job = TestJob(
             job_id=JobID(job_id),
             total=total,
+            bad_lines=bad_lines,
             started_at=str(datetime.now())
         )
-        self.redis.set(str(job_id), self._encode(dict(job)))
+        self._node(job.job_id).set(str(job_id), self._encode(dict(job)))
         return job
 
+    @metrics.database_write
     def update_test_job(self, job: TestJob, task: InferenceOutput):
         task_id = f"{self.topic}_{job.job_id}_{uuid.uuid4()}"
-        self.redis.set(task_id, self._encode(dict(task)))
+        self._node(job.job_id).set(task_id, self._encode(dict(task)))
+
+    @metrics.database_write
+    def stage_test_job(self, job: TestJob, items: List[Dict]):
+        items_key = f"{self.topic}:items:{job.job_id}"
+        with self._node(job.job_id).pipeline() as pipe:
+            for i in range(0, len(items), self.STAGE_CHUNK):
+                chunk = items[i:i + self.STAGE_CHUNK]
+                pipe.rpush(items_key, *[self._encode(item) for item in chunk])
+            pipe.set(f"{self.topic}:checkpoint:{job.job_id}", 0)
+            pipe.execute()
+        self.redis.sadd(f"{self.topic}:pending", str(job.job_id))
+
+    def get_test_items(self, job: TestJob, start: int, stop: int
+                       ) -> List[Dict]:
+        node = self._node(job.job_id)
+        items = node.lrange(f"{self.topic}:items:{job.job_id}",
+                            start, stop - 1)
+        return [self._decode(item) for item in items]
+
+    def get_test_checkpoint(self, job: TestJob) -> int:
+        node = self._node(job.job_id)
+        offset = node.get(f"{self.topic}:checkpoint:{job.job_id}")
+        return int(offset or 0)
+
+    @metrics.database_write
+    def advance_test_checkpoint(self, job: TestJob, offset: int,
+                                new_offset: int) -> bool:
+        return bool(self.advance_checkpoint(
+            keys=[f"{self.topic}:checkpoint:{job.job_id}"],
+            args=[offset, new_offset],
+            client=self._node(job.job_id)))
+
+    @metrics.database_write
+    def update_test_job_batch(self, job: TestJob,
+                              tasks: Dict[int, InferenceOutput],
+                              failed: List[int] = ()):
+        # Results are keyed by row, so a chunk run twice writes them once
+        node = self._node(job.job_id)
+        if failed:
+            node.sadd(f"{self.topic}:failed:{job.job_id}", *failed)
+        if not tasks:
+            return
+        node.mset({
+            f"{self.topic}_{job.job_id}_{index}": self._encode(dict(task))
+            for index, task in tasks.items()})
+
+    @metrics.database_write
+    def finish_test_job(self, job: TestJob):
+        job_id = job.job_id
+        node = self._node(job_id)
+        job = TestJob(**self._decode(node.get(str(job_id))))
+        job.end_at = str(datetime.now())
+        with node.pipeline() as pipe:
+            pipe.set(str(job_id), self._encode(dict(job)))
+            pipe.delete(f"{self.topic}:items:{job_id}",
+                        f"{self.topic}:checkpoint:{job_id}")
+            pipe.execute()
+        self.redis.srem(f"{self.topic}:pending", str(job_id))
+
+    def pending_test_jobs(self) -> List[TestJob]:
+        job_ids = self.redis.smembers(f"{self.topic}:pending")
+        jobs = [self._node(job_id.decode()).get(job_id)
+                for job_id in job_ids]
+        return [TestJob(**self._decode(job)) for job in jobs
+                if job is not None]
 
     def get_train_job(self, job_id: JobID) -> TrainJob:
-        job = self._decode(self.redis.get(job_id))
+        job = self._decode(self._node(job_id).get(job_id))
         return TrainJob(**job)
 
+    @metrics.database_write
     def create_train_job(self) -> TrainJob:
         job_id = uuid.uuid4()
         job = TrainJob(
@@ -59,13 +157,29 @@ class RedisDatabase(DatabaseInterface):
             total=100,
             started_at=str(datetime.now())
         )
-        self.redis.set(str(job_id), self._encode(dict(job)))
+        self._node(job_id).set(str(job_id), self._encode(dict(job)))
         return job
 
+    @metrics.database_write
     def update_train_job(self, job: TrainJob, version: ModelVersion):
         job_id = job.job_id
         job = self.get_train_job(job_id)
         job.processed = job.total
         job.version = version
         job.end_at = str(datetime.now())
-        self.redis.set(str(job_id), self._encode(dict(job)))
+        self._node(job_id).set(str(job_id), self._encode(dict(job)))
+
+    @metrics.database_write
+    def update_train_progress(self, job: TrainJob, processed: int):
+        job_id = job.job_id
+        job = self.get_train_job(job_id)
+        job.processed = processed
+        self._node(job_id).set(str(job_id), self._encode(dict(job)))
+
+    @metrics.database_write
+    def fail_train_job(self, job: TrainJob, error: str):
+        job_id = job.job_id
+        job = self.get_train_job(job_id)
+        job.error = error
+        job.end_at = str(datetime.now())
+        self._node(job_id).set(str(job_id), self._encode(dict(job)))
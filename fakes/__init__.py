@@ -0,0 +1,111 @@
+import threading
+from typing import List
+from ml_sdk.communication.redis import (RedisDispatcher, RedisWorker,
+                                        RedisSettings)
+from ml_sdk.database.redis import RedisDatabase
+from ml_sdk.database.mongo import MongoDatabase, MongoSettings
+from ml_sdk.io import TextInput
+from ml_sdk.io.output import ClassificationOutput
+from ml_sdk.io.version import ModelVersion
+from ml_sdk.service import MLServiceInterface
+
+# In-process stand-ins for Redis (fakeredis) and Mongo (mongomock), shared
+# by all the fake nodes of a process
+_servers = {}
+_mongo = None
+
+
+def fake_redis(conf: dict = None):
+    # One server by host and port, to stand in for sharded setups too
+    import fakeredis
+
+    conf = conf or {}
+    address = (conf.get('host'), conf.get('port'))
+    if address not in _servers:
+        _servers[address] = fakeredis.FakeServer()
+    return fakeredis.FakeStrictRedis(server=_servers[address],
+                                     db=conf.get('db', 0))
+
+
+def fake_mongo(settings: MongoSettings = None):
+    import mongomock
+
+    global _mongo
+    if _mongo is None:
+        _mongo = mongomock.MongoClient()
+    return _mongo
+
+
+class FakeRedisWorker(RedisWorker):
+    _connect = staticmethod(fake_redis)
+
+
+class FakeRedisDispatcher(RedisDispatcher):
+    _connect = staticmethod(fake_redis)
+
+
+class FakeRedisDatabase(RedisDatabase):
+    _connect = staticmethod(fake_redis)
+
+
+class FakeMongoDatabase(MongoDatabase):
+    _connect = staticmethod(fake_mongo)
+
+
+class FakeService(MLServiceInterface):
+    # Echoes the text upper cased, with versions kept in memory
+    MODEL_NAME = 'fake'
+    INPUT_TYPE = TextInput
+    OUTPUT_TYPE = ClassificationOutput
+    COMMUNICATION_TYPE = FakeRedisWorker
+    DATABASE_TYPE = FakeRedisDatabase
+
+    def __init__(self):
+        super().__init__()
+        version = {'version': 'fake', 'scores': None}
+        self._config = {'enabled': version, 'availables': [version]}
+
+    def _read_config(self):
+        return self._config
+
+    def _write_config(self, new_config):
+        self._config = new_config
+
+    def _deploy(self, version: ModelVersion):
+        pass
+
+    def _predict(self, inference_input: TextInput) -> ClassificationOutput:
+        return ClassificationOutput(input=inference_input.dict(),
+                                    prediction=inference_input.text.upper(),
+                                    score=1)
+
+    def _train(self, input_: List[ClassificationOutput]) -> ModelVersion:
+        return ModelVersion(version=f"fake-{len(input_)}")
+
+
+def serve_in_thread(service: MLServiceInterface) -> threading.Thread:
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def dispatcher(model_name: str = FakeService.MODEL_NAME, **settings):
+    settings.setdefault('nodes', FakeService.REDIS_NODES)
+    return FakeRedisDispatcher(RedisSettings(topic=model_name, **settings))
+
+
+def database(model_name: str = FakeService.MODEL_NAME):
+    return FakeRedisDatabase(RedisSettings(topic=f"{model_name}_jobs",
+                                           nodes=FakeService.REDIS_NODES))
+
+
+__all__ = [
+    "FakeRedisWorker",
+    "FakeRedisDispatcher",
+    "FakeRedisDatabase",
+    "FakeMongoDatabase",
+    "FakeService",
+    "serve_in_thread",
+    "dispatcher",
+    "database",
+]
@@ -21,10 +21,14 @@ class Job(Output):
     processed: int = 0
     started_at: str = None
     end_at: str = None
+    error: str = None
 
 
 class TestJob(Job):
     results: List[Dict] = []
+    bad_lines: int = 0
+    # Rows the model failed to score
+    failed: List[int] = []
 
 
 class TrainJob(Job):
@@ -10,6 +10,28 @@ class Parameter(BaseModel):
 ParametersInput = List[Parameter]
 
 
+class NDArray:
+    # Field type for numpy arrays, sent through the queue as raw buffers
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        # Imported on the first array, not with ml_sdk.io
+        try:
+            import numpy as np
+        except ImportError:
+            raise TypeError("numpy is required for NDArray fields")
+        if isinstance(value, np.ndarray):
+            return value
+        return np.asarray(value)
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type='array', items={})
+
+
 class Input(BaseModel):
     pass
 
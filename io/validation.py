@@ -0,0 +1,21 @@
+from typing import Dict, Iterable, List, Type
+from pydantic import BaseModel, parse_obj_as
+
+
+# Payloads are validated once at the edge (API request, file rows), data
+# coming from the other side of the queue is trusted and built without
+# validation. Unknown keys are still dropped, as validation would do.
+def build(model: Type[BaseModel], data: Dict, trusted: bool = False):
+    if trusted:
+        fields = model.__fields__
+        return model.construct(**{k: v for k, v in data.items()
+                                  if k in fields})
+    return model(**data)
+
+
+def build_list(model: Type[BaseModel], items: Iterable[Dict],
+               trusted: bool = False) -> List:
+    if trusted:
+        return [build(model, i, trusted=True) for i in items]
+    # pydantic caches the List[model] parsing type between calls
+    return parse_obj_as(List[model], list(items))
@@ -0,0 +1,247 @@
+"""Replay a JSONL request log against a running MLAPI and report throughput,
+errors and latency percentiles as JSON.
+
+Each line of the log is a request:
+
+    {"path": "/predict", "json": {"text": "..."}}
+    {"path": "/test", "file": "batch.csv"}
+    {"path": "/test/{job_id}"}
+
+A line without "path" is the body of a /predict. {job_id} is replaced by
+the last job created by a /test upload. Lines are replayed in order, from
+the start again until --requests are sent or --duration is over.
+
+    ml-sdk-loadgen http://localhost:8000/model requests.jsonl \\
+        --username user --password secret --rps 50 --duration 60
+"""
+import argparse
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_log(path: str):
+    requests = []
+    with open(path) as log:
+        for line in log:
+            line = line.strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            if 'path' not in request:
+                request = {'path': '/predict', 'json': request}
+            requests.append(request)
+    if not requests:
+        raise ValueError(f"No requests in {path}")
+    return requests
+
+
+def get_token(url: str, username: str, password: str, timeout: float):
+    data = urllib.parse.urlencode({'username': username,
+                                   'password': password}).encode()
+    with urllib.request.urlopen(url, data=data, timeout=timeout) as response:
+        return json.load(response)['access_token']
+
+
+def multipart(filename: str):
+    boundary = uuid.uuid4().hex
+    media_type = (mimetypes.guess_type(filename)[0] or
+                  'application/octet-stream')
+    with open(filename, 'rb') as file:
+        content = file.read()
+    body = b"".join([
+        f"--{boundary}\r\n".encode(),
+        (f'Content-Disposition: form-data; name="input_"; '
+         f'filename="{os.path.basename(filename)}"\r\n').encode(),
+        f"Content-Type: {media_type}\r\n\r\n".encode(),
+        content,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, requests, token: str = None,
+                 timeout: float = 30):
+        self.base_url = base_url.rstrip('/')
+        self.requests = requests
+        self.timeout = timeout
+        self.headers = {'Authorization': f"Bearer {token}"} if token else {}
+        self.job_id = None
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def send(self, request: dict, scheduled: float = None):
+        # Latency counts from the scheduled time when running open loop,
+        # so a slow server can't hide the requests it delayed
+        start = scheduled if scheduled is not None else time.perf_counter()
+        endpoint = path = request['path']
+        if '{job_id}' in path:
+            if self.job_id is None:
+                return
+            path = path.replace('{job_id}', self.job_id)
+
+        headers = dict(self.headers)
+        if 'file' in request:
+            data, headers['Content-Type'] = multipart(request['file'])
+        elif 'json' in request:
+            data = json.dumps(request['json']).encode()
+            headers['Content-Type'] = 'application/json'
+        else:
+            data = None
+
+        http_request = urllib.request.Request(self.base_url + path,
+                                              data=data, headers=headers)
+        status = None
+        try:
+            with urllib.request.urlopen(http_request,
+                                        timeout=self.timeout) as response:
+                status = response.status
+                body = response.read()
+            if 'file' in request:
+                self.job_id = json.loads(body)['job_id']
+        except urllib.error.HTTPError as exc:
+            status = exc.code
+        except Exception as exc:
+            status = type(exc).__name__
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            if isinstance(status, int) and status < 400:
+                self.latencies[endpoint].append(latency)
+            else:
+                self.errors[endpoint][str(status)] += 1
+
+    def schedule(self, total: int = None, duration: float = None):
+        # Requests from the log in order, cycling, until the limits
+        end = time.perf_counter() + duration if duration else None
+        n = 0
+        while total is None or n < total:
+            if end is not None and time.perf_counter() >= end:
+                return
+            yield self.requests[n % len(self.requests)]
+            n += 1
+
+    def open_loop(self, rps: float, max_clients: int, **limits):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_clients) as pool:
+            for n, request in enumerate(self.schedule(**limits)):
+                scheduled = start + n / rps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.send, request, scheduled)
+
+    def closed_loop(self, clients: int, **limits):
+        requests = self.schedule(**limits)
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    request = next(requests, None)
+                if request is None:
+                    return
+                self.send(request)
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def report(self, elapsed: float):
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[endpoint]
+            errors = dict(self.errors[endpoint])
+            total = len(latencies) + sum(errors.values())
+            endpoints[endpoint] = {
+                'requests': total,
+                'error_rate': round(sum(errors.values()) / total, 4),
+                'errors': errors,
+                **percentiles(latencies),
+            }
+        total = sum(e['requests'] for e in endpoints.values())
+        return {
+            'seconds': round(elapsed, 3),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+            'endpoints': endpoints,
+        }
+
+
+def percentiles(latencies, points=(50, 90, 99)):
+    # Nearest rank percentiles and maximum of latencies in seconds, in
+    # milliseconds. Also used by ml_sdk.benchmarks.
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    result = {f"p{p}_ms": round(
+        latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000,
+        3) for p in points}
+    result['max_ms'] = round(latencies[-1] * 1000, 3)
+    return result
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='ml-sdk-loadgen',
+        description="Replay a JSONL request log against a MLAPI")
+    parser.add_argument('url', help="API base url, with the router prefix")
+    parser.add_argument('log', help="JSONL request log")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--rps', type=float,
+                      help="Open loop: requests started per second")
+    mode.add_argument('--clients', type=int, default=1,
+                      help="Closed loop: clients sending one after another")
+    parser.add_argument('--max-clients', type=int, default=64,
+                        help="Requests in flight at most, open loop")
+    parser.add_argument('--requests', type=int,
+                        help="Requests to send, the log length by default")
+    parser.add_argument('--duration', type=float,
+                        help="Seconds to run, instead of --requests")
+    parser.add_argument('--token', help="Bearer token already issued")
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--token-url',
+                        help="Token endpoint, {url}/token by default")
+    parser.add_argument('--timeout', type=float, default=30)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    requests = read_log(args.log)
+
+    token = args.token
+    if args.username:
+        token = get_token(args.token_url or f"{args.url.rstrip('/')}/token",
+                          args.username, args.password, args.timeout)
+
+    generator = LoadGenerator(args.url, requests, token, args.timeout)
+    limits = {'total': args.requests, 'duration': args.duration}
+    if args.requests is None and args.duration is None:
+        limits['total'] = len(requests)
+
+    start = time.perf_counter()
+    if args.rps:
+        generator.open_loop(args.rps, args.max_clients, **limits)
+    else:
+        generator.closed_loop(args.clients, **limits)
+    print(json.dumps(generator.report(time.perf_counter() - start),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import functools
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:  # Metrics are only recorded when installed
+    prometheus_client = None
+
+
+class _NoMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    @contextmanager
+    def time(self):
+        yield
+
+
+def _metric(kind, name, documentation, labels):
+    if prometheus_client is None:
+        return _NoMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labels)
+
+
+enabled = prometheus_client is not None
+
+# API side
+DISPATCH_LATENCY = _metric(
+    'Histogram', 'ml_sdk_dispatch_seconds',
+    "Time from dispatch to reply", ['model', 'method'])
+DISPATCH_TIMEOUTS = _metric(
+    'Counter', 'ml_sdk_dispatch_timeouts_total',
+    "Dispatches without a reply before the deadline", ['model', 'method'])
+DISPATCH_REJECTED = _metric(
+    'Counter', 'ml_sdk_dispatch_rejected_total',
+    "Messages rejected by admission control", ['model', 'lane'])
+QUEUE_DEPTH = _metric(
+    'Gauge', 'ml_sdk_queue_depth',
+    "Messages waiting in each lane", ['model', 'lane'])
+
+# Worker side
+QUEUE_WAIT = _metric(
+    'Histogram', 'ml_sdk_queue_wait_seconds',
+    "Time messages wait in the queue", ['model', 'method'])
+HANDLER_LATENCY = _metric(
+    'Histogram', 'ml_sdk_handler_seconds',
+    "Time running the service method", ['model', 'method'])
+
+# Both
+CODEC_LATENCY = _metric(
+    'Histogram', 'ml_sdk_codec_seconds',
+    "Time encoding and decoding messages", ['model', 'operation'])
+DATABASE_WRITE_LATENCY = _metric(
+    'Histogram', 'ml_sdk_database_write_seconds',
+    "Time writing jobs and results", ['database', 'operation'])
+
+
+def observe_since(metric, start: float, *labels):
+    metric.labels(*labels).observe(time.perf_counter() - start)
+
+
+def database_write(func):
+    # Records the latency of a DatabaseInterface write method
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        labels = (type(self).__name__, func.__name__)
+        with DATABASE_WRITE_LATENCY.labels(*labels).time():
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def latest():
+    # Exposition of this process metrics and its content type
+    if prometheus_client is None:
+        return b"", "text/plain"
+    return (prometheus_client.generate_latest(),
+            prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def start_http_server(port: int):
+    if prometheus_client is None:
+        raise ImportError("prometheus_client is required to export metrics")
+    prometheus_client.start_http_server(port)
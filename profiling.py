@@ -0,0 +1,129 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class SamplingProfiler:
+    # Samples the stacks of every thread, so handlers running in a thread
+    # pool are seen too, at a low and fixed cost
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, limit: int = 50):
+        self._stop.set()
+        self._thread.join()
+        # Collapsed stacks, as read by flame graph tools
+        return {
+            'samples': self.samples,
+            'stacks': {';'.join(stack): count for stack, count
+                       in self._stacks.most_common(limit)},
+        }
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    self._stacks[self._stack(frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def _stack(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:"
+                         f"{frame.f_lineno})")
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+
+class DeterministicProfiler:
+    # cProfile of the thread reading the queue, where handlers run unless
+    # the worker concurrency is above 1
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self, limit: int = 50):
+        self._profile.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return {'stats': output.getvalue()}
+
+
+PROFILERS = {
+    'sampling': SamplingProfiler,
+    'cprofile': DeterministicProfiler,
+}
+
+
+class Profiler:
+    # State of the profiling sessions of one worker, driven by broadcasts
+    def __init__(self):
+        self._session = None
+        self._started_at = None
+        self._snapshot = None
+        # Kind of the running session, if any
+        self.kind = None
+
+    def start(self, kind: str = 'sampling', **options) -> dict:
+        if self._session is not None:
+            return {'error': "Profiling already started"}
+        self._session = PROFILERS[kind](**options)
+        self._session.start()
+        self._started_at = time.time()
+        self.kind = kind
+        return {'kind': kind, 'started_at': self._started_at}
+
+    def stop(self, limit: int = 50) -> dict:
+        if self._session is None:
+            return {'error': "Profiling not started"}
+        result = self._session.stop(limit)
+        result['seconds'] = time.time() - self._started_at
+        self._session = None
+        self.kind = None
+        return result
+
+    def memory_snapshot(self, limit: int = 20, frames: int = 1) -> dict:
+        # First call starts tracing, then each one returns the allocation
+        # growth since the previous snapshot
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._snapshot = None
+
+        snapshot = tracemalloc.take_snapshot()
+        previous, self._snapshot = self._snapshot, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        result = {'traced_bytes': current, 'peak_bytes': peak, 'growth': []}
+        if previous is None:
+            return result
+
+        for stat in snapshot.compare_to(previous, 'lineno')[:limit]:
+            result['growth'].append({
+                'traceback': [str(frame) for frame in stat.traceback],
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+                'size': stat.size,
+            })
+        return result
+
+    def memory_stop(self) -> dict:
+        tracemalloc.stop()
+        self._snapshot = None
+        return {}
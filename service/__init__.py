@@ -1,38 +1,127 @@
 import os
 import json
+import asyncio
+import contextvars
+import inspect
 import logging
+import multiprocessing
+import random
+import threading
+import time
+from contextlib import contextmanager
 from typing import List, Dict
 from abc import ABCMeta, abstractmethod
-from ml_sdk.communication.redis import RedisWorker, RedisSettings
+from ml_sdk import backends, metrics
+from ml_sdk.communication import BATCH, ServiceError
+from ml_sdk.io import TestJob, TrainJob
 from ml_sdk.io.input import (
     InferenceInput,
 )
+from ml_sdk.io.output import InferenceOutput
+from ml_sdk.io.validation import build, build_list
 from ml_sdk.io.version import ModelVersion
+from ml_sdk.service.health import serve_health
+from ml_sdk.service.models import ModelCache
 
 logger = logging.getLogger(__name__)
 
+# Model of the version serving the current request, see `_load`
+_current_model = contextvars.ContextVar('current_model', default=None)
+
 
 class MLServiceInterface(metaclass=ABCMeta):
     INPUT_TYPE = None
     OUTPUT_TYPE = None
     MODEL_NAME = None
-    COMMUNICATION_TYPE = RedisWorker
+    # Backend classes, or their names in ml_sdk.backends
+    COMMUNICATION_TYPE = 'redis'
+    DATABASE_TYPE = 'redis'
     BINARY_FOLDER = "/app/models/"
     VERSIONS_FILE = "versions.json"
+    # Background training: run `_train` in a child process so the worker
+    # keeps serving, with lowered priority and at most TRAIN_CPUS cores
+    TRAIN_IN_BACKGROUND = False
+    TRAIN_NICENESS = 10
+    TRAIN_CPUS = None
+    # Micro-batching: score up to PREDICT_BATCH_SIZE queued predictions in
+    # one `_predict_batch` call, waiting at most PREDICT_BATCH_WAIT_MS
+    PREDICT_BATCH_SIZE = 1
+    PREDICT_BATCH_WAIT_MS = 0
+    # Messages handled at the same time, for I/O bound or async `_predict`
+    CONCURRENCY = 1
+    # Skip revalidation of inputs already validated by the API
+    TRUSTED_INPUT = False
+    # Serialization for replies and jobs, e.g. 'msgpack' or 'msgpack+zstd'
+    CODEC = 'msgpack'
+    # Rows of a test job scored per message, progress is saved after each
+    TEST_JOB_CHUNK_SIZE = 100
+    # Serve Prometheus metrics on this port (needs prometheus_client)
+    METRICS_PORT = None
+    # Redis shards as "host:port", the first one also takes broadcasts and
+    # locks. SHARDS are the indexes this worker consumes, all by default.
+    REDIS_NODES = None
+    SHARDS = None
+    # Sample inputs (a JSON list) run through the model after each deploy,
+    # before taking traffic. Optional, looked up next to VERSIONS_FILE.
+    WARMUP_FILE = "warmup.json"
+    # Workers announce they are ready in Redis for READY_TTL seconds,
+    # renewed while they run. HEALTH_PORT also serves /live and /ready.
+    READY_TTL = 15
+    HEALTH_PORT = None
+    # Versions kept loaded at once by services implementing `_load`, up to
+    # MEMORY_BUDGET_MB of the process memory they took when loading. By
+    # default the enabled version and those in the traffic split.
+    MAX_LOADED_VERSIONS = None
+    MEMORY_BUDGET_MB = None
 
     def __init__(self):
         # Validations
         self._validate_instance()
 
         # Communication setup
-        if self.COMMUNICATION_TYPE == RedisWorker:
-            self.settings = RedisSettings(topic=self.MODEL_NAME, host='redis')
+        from ml_sdk.communication.redis import RedisWorker, RedisSettings
+        self.COMMUNICATION_TYPE = backends.resolve('worker',
+                                                   self.COMMUNICATION_TYPE)
+        if issubclass(self.COMMUNICATION_TYPE, RedisWorker):
+            self.settings = RedisSettings(
+                topic=self.MODEL_NAME, host='redis',
+                batch_size=self.PREDICT_BATCH_SIZE,
+                batch_wait_ms=self.PREDICT_BATCH_WAIT_MS,
+                concurrency=self.CONCURRENCY,
+                codec=self.CODEC,
+                nodes=self.REDIS_NODES,
+                shards=self.SHARDS)
         else:
             logger.error("Communication type not implemented")
             raise NotImplementedError
 
         self.worker = self.COMMUNICATION_TYPE(self.settings, handler=self)
 
+        # Database setup
+        from ml_sdk.database.redis import RedisDatabase
+        self.DATABASE_TYPE = backends.resolve('database', self.DATABASE_TYPE)
+        if issubclass(self.DATABASE_TYPE, RedisDatabase):
+            db_settings = RedisSettings(topic=f"{self.MODEL_NAME}_jobs",
+                                        host='redis', codec=self.CODEC,
+                                        nodes=self.REDIS_NODES)
+        else:
+            from ml_sdk.database.mongo import MongoDatabase, MongoSettings
+            if not issubclass(self.DATABASE_TYPE, MongoDatabase):
+                logger.error("Database type not implemented")
+                raise NotImplementedError
+            db_settings = MongoSettings(db=self.MODEL_NAME, host='mongo')
+        self.db_settings = db_settings
+        self.database = self.DATABASE_TYPE(db_settings)
+        self._train_job = None
+        self.ready = False
+        self._ready_at = None
+        self.models = ModelCache(self.MAX_LOADED_VERSIONS,
+                                 self.MEMORY_BUDGET_MB)
+        # Weights by version for requests without one
+        self.traffic = {}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
     def _read_config(self):
         file_path = os.path.join(self.BINARY_FOLDER, self.VERSIONS_FILE)
         with open(file_path) as setup_file:
@@ -44,13 +133,180 @@ class MLServiceInterface(metaclass=ABCMeta):
         with open(file_path, "w") as setup_file:
             json.dump(new_config, setup_file, indent=4)
 
-    def predict(self, input_: Dict) -> Dict:
-        inference_input = self.INPUT_TYPE.preprocess(input_)
-        inference_input = self.INPUT_TYPE(**input_)
-        output = self._predict(inference_input)
+    def predict(self, input_: Dict, version: str = None) -> Dict:
+        inference_input = self._parse_input(input_)
+        with self._using(version):
+            output = self._resolve(self._predict(inference_input))
         logger.info(f"Prediction {output}")
         return output.dict()
 
+    def predict_batch(self, input_: List[Dict]) -> List[Dict]:
+        inference_inputs = [self._parse_input(i) for i in input_]
+        with self._using():
+            outputs = self._resolve(self._predict_batch(inference_inputs))
+        logger.info(f"Predicted batch of {len(outputs)}")
+        return [output.dict() for output in outputs]
+
+    @property
+    def current_model(self):
+        # Model returned by `_load` for the version serving this request
+        return _current_model.get()
+
+    @property
+    def multi_version(self) -> bool:
+        return type(self)._load is not MLServiceInterface._load
+
+    def _load(self, version: ModelVersion):
+        # Override to host several versions in this worker: return the
+        # model of `version` and use `self.current_model` in `_predict`
+        raise NotImplementedError
+
+    @contextmanager
+    def _using(self, version: str = None):
+        if not self.multi_version:
+            if version not in (None, self.version.version):
+                raise ServiceError(
+                    f"{self.MODEL_NAME} only serves its enabled version "
+                    f"{self.version.version}", status=501)
+            yield
+            return
+
+        version = self._route(version)
+        model = self.models.get((self.MODEL_NAME, version),
+                                lambda: self._load(self._find(version)))
+        token = _current_model.set(model)
+        try:
+            yield
+        finally:
+            _current_model.reset(token)
+
+    def _route(self, version: str = None) -> str:
+        # Pinned version, or one drawn by the traffic weights
+        if version is not None:
+            return version
+        if self.traffic:
+            versions = list(self.traffic)
+            weights = [self.traffic[v] for v in versions]
+            return random.choices(versions, weights)[0]
+        return self.version.version
+
+    def _find(self, version: str) -> ModelVersion:
+        for conf in self._read_config()["availables"]:
+            if conf["version"] == version:
+                return ModelVersion(**conf)
+        raise ServiceError(f"Unknown version {version}", status=404)
+
+    def _reserve_models(self):
+        # Room for the enabled version and the ones in the traffic split,
+        # less would load a model again on most requests
+        if not self.multi_version:
+            return
+        needed = len(set(self.traffic) | {self.version.version})
+        self.models.reserve(self.MODEL_NAME, needed)
+        if self.MAX_LOADED_VERSIONS and needed > self.MAX_LOADED_VERSIONS:
+            logger.warning(f"Serving {needed} versions with room for "
+                           f"{self.MAX_LOADED_VERSIONS} loaded, raise "
+                           f"MAX_LOADED_VERSIONS")
+
+    def split(self, input_: Dict[str, float]) -> Dict[str, float]:
+        # Share of the requests without version going to each one, an
+        # empty split sends them all to the enabled version
+
+        def update_config(traffic):
+            config = self._read_config()
+            config["traffic"] = traffic
+            self._write_config(config)
+
+        input_ = {version: weight for version, weight in input_.items()
+                  if weight > 0}
+        for version in input_:
+            self._find(version)
+        self.worker.exec_critical(update_config, input_)
+        self.traffic = input_
+        self._reserve_models()
+        logger.info(f"Traffic split {self.traffic}")
+        return self.traffic
+
+    def run_test_job(self, job: Dict):
+        # Score the next chunk of a staged test job and queue the rest
+        job = TestJob(**job)
+        offset = self.database.get_test_checkpoint(job)
+        if offset >= job.total:
+            self.database.finish_test_job(job)
+            return None
+
+        items = self.database.get_test_items(
+            job, offset, offset + self.TEST_JOB_CHUNK_SIZE)
+        inputs = {}
+        for index, item in enumerate(items, start=offset):
+            # Staged rows come straight from the file, always validate them
+            try:
+                item = self.INPUT_TYPE.preprocess(item)
+                inputs[index] = build(self.INPUT_TYPE, item)
+            except Exception as e:
+                logger.info(f"Ommited {item} Failure during parsing: {e}")
+
+        outputs, failed = self._predict_chunk(inputs)
+        self.database.update_test_job_batch(job, outputs, failed)
+
+        # Another worker already moved past this chunk (e.g. a resumed job)
+        new_offset = offset + len(items)
+        if not self.database.advance_test_checkpoint(job, offset, new_offset):
+            return None
+
+        if items and new_offset < job.total:
+            self.worker.enqueue('run_test_job', lane=BATCH, job=job.dict())
+        else:
+            self.database.finish_test_job(job)
+            logger.info(f"Test job {job.job_id} finished")
+        return None
+
+    def _predict_chunk(self, inputs: Dict[int, InferenceInput]):
+        # When the batch fails its rows are scored one by one, so a bad
+        # row is recorded as failed instead of stalling the job
+        try:
+            with self._using():
+                outputs = self._resolve(
+                    self._predict_batch(list(inputs.values())))
+            assert len(outputs) == len(inputs)
+            return dict(zip(inputs, outputs)), []
+        except Exception:
+            logger.exception("Test job batch failed, scoring by row")
+
+        outputs, failed = {}, []
+        for index, inference_input in inputs.items():
+            try:
+                with self._using():
+                    outputs[index] = self._resolve(
+                        self._predict(inference_input))
+            except Exception as e:
+                logger.info(f"Row {index} failed: {e}")
+                failed.append(index)
+        return outputs, failed
+
+    def _resume_test_jobs(self):
+        # Jobs interrupted by a restart continue from their checkpoint
+        for job in self.database.pending_test_jobs():
+            logger.info(f"Resuming test job {job.job_id}")
+            self.worker.enqueue('run_test_job', lane=BATCH, job=job.dict())
+
+    def _resolve(self, result):
+        # `_predict` may be a coroutine, run it in the service event loop
+        if not inspect.iscoroutine(result):
+            return result
+
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,
+                                 daemon=True).start()
+
+        return asyncio.run_coroutine_threadsafe(result, self._loop).result()
+
+    def _parse_input(self, input_: Dict) -> InferenceInput:
+        input_ = self.INPUT_TYPE.preprocess(input_)
+        return build(self.INPUT_TYPE, input_, trusted=self.TRUSTED_INPUT)
+
     def enabled_version(self) -> Dict:
         return self.version.dict()
 
@@ -71,7 +327,20 @@ class MLServiceInterface(metaclass=ABCMeta):
         items = [self.OUTPUT_TYPE(**reg).dict() for reg in items]
         self.train(items)
 
-    def train(self, input_: List[Dict]) -> Dict:
+    def train(self, input_: List[Dict], job: Dict = None) -> Dict:
+        if self.TRAIN_IN_BACKGROUND and job is not None:
+            self._train_in_background(TrainJob(**job), input_)
+            return None
+
+        version = self._run_train(input_)
+        return version.dict()
+
+    def report_train_progress(self, processed: int):
+        # To be called from `_train` to publish progress (0 to 100)
+        if self._train_job is not None:
+            self.database.update_train_progress(self._train_job, processed)
+
+    def _run_train(self, input_: List[Dict]) -> ModelVersion:
 
         def update_config(version):
             # Avail new version
@@ -81,7 +350,8 @@ class MLServiceInterface(metaclass=ABCMeta):
 
         logger.info("Starting training")
         # Parse input
-        train_input = [self.OUTPUT_TYPE(**i) for i in input_]
+        train_input = build_list(self.OUTPUT_TYPE, input_,
+                                 trusted=self.TRUSTED_INPUT)
 
         # Launch train
         version = self._train(train_input)
@@ -90,7 +360,39 @@ class MLServiceInterface(metaclass=ABCMeta):
 
         logger.info(f"New version available {version}")
 
-        return version.dict()
+        return version
+
+    def _train_in_background(self, job: TrainJob, input_: List[Dict]):
+        # Reap finished trainings
+        multiprocessing.active_children()
+
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=self._train_process,
+                                  args=(job, input_))
+        process.start()
+        logger.info(f"Training job {job.job_id} started (pid {process.pid})")
+
+    def _train_process(self, job: TrainJob, input_: List[Dict]):
+        # Connections inherited through the fork belong to the parent,
+        # which keeps using them (MongoClient isn't fork safe)
+        self.database = self.DATABASE_TYPE(self.db_settings)
+        self.worker.reconnect()
+        self._limit_train_resources()
+        self._train_job = job
+        try:
+            version = self._run_train(input_)
+        except Exception as e:
+            logger.exception(f"Training job {job.job_id} failed")
+            # Nobody waits for this process, the job tells the failure
+            self.database.fail_train_job(job, repr(e))
+            raise
+        self.database.update_train_job(job=job, version=version.dict())
+
+    def _limit_train_resources(self):
+        os.nice(self.TRAIN_NICENESS)
+        if self.TRAIN_CPUS and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, cpus[-self.TRAIN_CPUS:])
 
     def deploy(self, input_: Dict):
 
@@ -106,20 +408,24 @@ class MLServiceInterface(metaclass=ABCMeta):
 
             return target_version
 
-        self.version = ModelVersion(**input_)
-
-        target_version = self.worker.exec_critical(update_config, self.version)
-
-        if target_version:
-            self._deploy(target_version)
-            logger.info(f"Version {target_version} succesfully deployed")
-        else:
-            logger.info(f"Can't find version {input_['version']} to deploy")
+        target_version = self.worker.exec_critical(update_config,
+                                                   ModelVersion(**input_))
+        if not target_version:
+            # Raised, so the worker acknowledges the deploy with an error
+            raise ServiceError(f"Can't find version {input_['version']} "
+                               f"to deploy", status=404)
 
+        self.version = target_version
+        self._deploy(target_version)
+        self._reserve_models()
+        self._warmup()
+        logger.info(f"Version {target_version} succesfully deployed")
         return target_version
 
     @abstractmethod
     def _deploy(self, version: ModelVersion):
+        # Runs on the control thread while predictions go on: build the new
+        # model aside and swap it in with a single assignment
         pass
 
     @abstractmethod
@@ -130,6 +436,47 @@ class MLServiceInterface(metaclass=ABCMeta):
     def _train(self, input_: List[InferenceInput]):
         pass
 
+    def _predict_batch(self, inference_inputs: List[InferenceInput]
+                       ) -> List[InferenceOutput]:
+        # Override with a vectorized implementation when the model has one
+        if inspect.iscoroutinefunction(self._predict):
+            async def gather():
+                return await asyncio.gather(
+                    *(self._predict(i) for i in inference_inputs))
+            return gather()
+        return [self._predict(i) for i in inference_inputs]
+
+    def _warmup(self):
+        file_path = os.path.join(self.BINARY_FOLDER, self.WARMUP_FILE)
+        if not os.path.exists(file_path):
+            return
+
+        with open(file_path) as warmup_file:
+            samples = json.load(warmup_file)
+        start = time.perf_counter()
+        try:
+            inputs = [self._parse_input(sample) for sample in samples]
+            # Also loads the enabled version when hosting several
+            with self._using(self.version.version):
+                for inference_input in inputs:
+                    self._resolve(self._predict(inference_input))
+                if self.PREDICT_BATCH_SIZE > 1:
+                    self._resolve(self._predict_batch(inputs))
+        except Exception:
+            logger.exception("Warm up failed")
+            return
+        logger.info(f"Warmed up with {len(samples)} samples in "
+                    f"{time.perf_counter() - start:.3f}s")
+
+    def _status(self) -> Dict:
+        status = {'version': self.version.version, 'since': self._ready_at}
+        if self.multi_version:
+            status['loaded'] = [version for name, version
+                                in self.models.keys()
+                                if name == self.MODEL_NAME]
+            status['traffic'] = self.traffic
+        return status
+
     def _validate_instance(self):
         assert self.INPUT_TYPE is not None, "You have to setup an INPUT_TYPE"
         assert self.OUTPUT_TYPE is not None, "You have to setup an OUTPUT_TYPE"
@@ -138,9 +485,38 @@ class MLServiceInterface(metaclass=ABCMeta):
         assert self.MODEL_NAME is not None, "You have to setup a MODEL_NAME"
 
     def serve_forever(self):
+        if self.METRICS_PORT is not None:
+            metrics.start_http_server(self.METRICS_PORT)
+
+        if self.HEALTH_PORT is not None:
+            serve_health(self.HEALTH_PORT, lambda: self.ready)
+
         # Deploy enabled version
         config = self._read_config()
         self.version = ModelVersion(**config['enabled'])
+        self.traffic = config.get('traffic', {})
+        self._reserve_models()
         self._deploy(self.version)
+        self._warmup()
         logger.info(f"Initialized with version {self.version}")
+
+        # Take traffic only once warm
+        self._ready_at = time.time()
+        self.worker.start_heartbeat(self.READY_TTL, self._status)
+        self.ready = True
+        self._resume_test_jobs()
         self.worker.serve_forever()
+
+
+def serve_many(*services: MLServiceInterface):
+    # Several models in one process, sharing the cache of loaded versions
+    # so the memory budget of the first one holds for all of them
+    models = services[0].models
+    threads = []
+    for service in services:
+        service.models = models
+        thread = threading.Thread(target=service.serve_forever, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
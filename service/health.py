@@ -0,0 +1,30 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+
+def serve_health(port: int, is_ready: Callable[[], bool]):
+    # /live answers while the process runs, /ready once the model is warm
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/live':
+                status = 200
+            elif self.path == '/ready':
+                status = 200 if is_ready() else 503
+            else:
+                status = 404
+            body = json.dumps({'status': status}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
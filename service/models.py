@@ -0,0 +1,87 @@
+import gc
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+def rss() -> int:
+    # Resident memory of the process in bytes, 0 where unknown
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class ModelCache:
+    # Loaded models by key, least recently used evicted first when over
+    # `max_models` (or the models reserved by their owners, when not set)
+    # or the memory budget. Sizes are the growth of the process memory
+    # while loading: loads run one at a time so they don't count each
+    # other, still an estimate as requests running meanwhile count too.
+    def __init__(self, max_models: int = None, memory_budget_mb: int = None):
+        self.max_models = max_models
+        self.memory_budget = (memory_budget_mb * 2 ** 20
+                              if memory_budget_mb else None)
+        self._models = OrderedDict()
+        self._reserved = {}
+        self._loading = threading.Lock()
+        self._lock = threading.RLock()
+
+    def reserve(self, owner: Hashable, count: int):
+        # Models `owner` expects to keep loaded at once
+        with self._lock:
+            self._reserved[owner] = count
+            self._evict()
+
+    def get(self, key: Hashable, load: Callable):
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+        # Loaded outside the cache lock, so hits don't wait for it, and
+        # only once when several requests ask for the same key
+        with self._loading:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+            before = rss()
+            model = load()
+            size = max(rss() - before, 0)
+
+            with self._lock:
+                self._models[key] = (model, size)
+                logger.info(f"Loaded model {key} ({size / 2 ** 20:.1f} MB)")
+                self._evict()
+            return model
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._models)
+
+    def size(self) -> int:
+        return sum(size for _, size in self._models.values())
+
+    def _evict(self):
+        evicted = False
+        # The model just loaded always stays
+        while len(self._models) > 1 and self._over_budget():
+            key, _ = self._models.popitem(last=False)
+            logger.info(f"Evicted model {key}")
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def _over_budget(self):
+        max_models = self.max_models or sum(self._reserved.values())
+        if max_models and len(self._models) > max_models:
+            return True
+        return (self.memory_budget is not None and
+                self.size() > self.memory_budget)
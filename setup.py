@@ -40,8 +40,15 @@ setup(
         'ml_sdk.communication',
         'ml_sdk.database',
         'ml_sdk.api',
+        'ml_sdk.fakes',
     ],
     package_dir={'ml_sdk': '.'},
     install_requires=requirements_common,
-    extras_require={'api': requirements_api}
+    entry_points={
+        'console_scripts': ['ml-sdk-loadgen=ml_sdk.loadgen:main'],
+    },
+    extras_require={'api': requirements_api,
+                    'metrics': ['prometheus_client'],
+                    'tracing': ['opentelemetry-api'],
+                    'test': ['pytest', 'fakeredis', 'mongomock', 'pyarrow']}
 )
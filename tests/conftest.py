@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+from ml_sdk import fakes
+from ml_sdk.communication.redis import RedisSettings
+
+
+@pytest.fixture(autouse=True)
+def fresh_servers():
+    # Every test talks to its own fake Redis, workers left running by
+    # other tests keep their old one
+    fakes._servers.clear()
+    yield
+    fakes._servers.clear()
+
+
+@pytest.fixture
+def eventually():
+    # Polls `check` until it returns something truthy, for what workers do
+    # in their threads
+    def wait(check, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            result = check()
+            if result or time.monotonic() > deadline:
+                return result
+            time.sleep(0.01)
+
+    return wait
+
+
+@pytest.fixture
+def worker():
+    # Worker without a handler, to read what dispatchers queue
+    def make(**settings):
+        return fakes.FakeRedisWorker(
+            RedisSettings(topic=fakes.FakeService.MODEL_NAME, **settings),
+            handler=None)
+
+    return make
+
+
+@pytest.fixture
+def drain():
+    # Every queued message, in the order the worker takes them
+    def read(node):
+        messages = []
+        while True:
+            message = node._consume_nowait()
+            if message is None:
+                return messages
+            messages.append(message[1])
+
+    return read
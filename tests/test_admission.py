@@ -0,0 +1,26 @@
+import pytest
+
+from ml_sdk.communication import BATCH, REALTIME, Overloaded
+from ml_sdk.fakes import dispatcher
+
+
+def test_full_lane_rejects_new_messages():
+    connector = dispatcher(max_queue_depth=2, retry_after=3)
+    connector.send('predict')
+    connector.send('predict')
+
+    with pytest.raises(Overloaded) as overloaded:
+        connector.send('predict')
+
+    assert overloaded.value.lane == REALTIME
+    assert overloaded.value.retry_after == 3
+    assert connector.queue_depth()[REALTIME] == 2
+
+
+def test_lanes_are_limited_on_their_own():
+    connector = dispatcher(max_queue_depth=1)
+    connector.send('predict')
+
+    connector.send('predict', lane=BATCH)
+
+    assert connector.queue_depth()[BATCH] == 1
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from ml_sdk.communication import ServiceError
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+def test_handler_failure_is_replied_and_the_worker_goes_on():
+    class Service(FakeService):
+        def _predict(self, inference_input):
+            if inference_input.text == 'bad':
+                raise RuntimeError("bad input")
+            return super()._predict(inference_input)
+
+    serve_in_thread(Service())
+    connector = dispatcher()
+
+    with pytest.raises(ServiceError) as error:
+        connector.dispatch('predict', input_={'text': 'bad'})
+    assert error.value.status == 500
+    assert connector.dispatch('predict', input_={'text': 'ok'}
+                              )['prediction'] == 'OK'
+
+
+def test_predicts_are_batched_and_failures_split_the_batch():
+    batches = []
+
+    class Service(FakeService):
+        PREDICT_BATCH_SIZE = 4
+        PREDICT_BATCH_WAIT_MS = 200
+
+        def _predict(self, inference_input):
+            if inference_input.text == 'bad':
+                raise RuntimeError("bad input")
+            return super()._predict(inference_input)
+
+        def _predict_batch(self, inference_inputs):
+            batches.append(len(inference_inputs))
+            return super()._predict_batch(inference_inputs)
+
+    connector = dispatcher()
+    keys = []
+    for text in ['a', 'bad', 'c']:
+        key = f"reply-{text}"
+        connector._produce(key, {'method': 'predict',
+                                 'input_': {'text': text}})
+        keys.append(key)
+    serve_in_thread(Service())
+
+    replies = {key: connector._consume(key, time.time() + 5)[1]
+               for key in keys}
+
+    assert batches[0] == 3
+    assert replies['reply-a']['prediction'] == 'A'
+    assert replies['reply-c']['prediction'] == 'C'
+    assert '__error__' in replies['reply-bad']
+
+
+def test_gathering_stops_at_the_first_other_message(worker, drain):
+    connector, node = dispatcher(), worker(batch_size=8, batch_wait_ms=200)
+    connector._produce('reply-a', {'method': 'predict', 'n': 1})
+    connector._produce('reply-b', {'method': 'train', 'n': 2})
+    connector._produce('reply-c', {'method': 'predict', 'n': 3})
+
+    key, kwargs = node._consume_nowait()
+    batch, pending = node._gather_batch(key, kwargs)
+
+    assert [m['n'] for _, m in batch] == [1]
+    assert [m['n'] for _, m in pending] == [2]
+    # The rest stays queued for other workers
+    assert [m['n'] for m in drain(node)] == [3]
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from ml_sdk.communication import ERROR, Overloaded
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+def payloads(connector):
+    return list(connector.redis.scan_iter(f"{connector.topic}:payload:*"))
+
+
+def test_full_lane_rejects_and_drops_the_claim_check():
+    connector = dispatcher(max_queue_depth=1, claim_check_threshold=1)
+    connector.send('predict', input_={'text': 'first'})
+
+    with pytest.raises(Overloaded):
+        connector.send('predict', input_={'text': 'second'})
+
+    assert len(payloads(connector)) == 1
+
+
+def test_claim_checked_message_is_loaded_once(worker):
+    connector, node = dispatcher(claim_check_threshold=1), worker()
+    connector.send('predict', input_={'text': 'x' * 100})
+
+    key, kwargs = node._consume_nowait()
+    assert kwargs['method'] == 'predict'
+    assert 'input_' not in kwargs
+    assert node._load_payload(key, kwargs)['input_'] == {'text': 'x' * 100}
+    assert not payloads(connector)
+
+
+def test_payloads_live_as_long_as_their_message(worker):
+    connector = dispatcher(claim_check_threshold=1, claim_check_ttl=5)
+    connector._produce('late', {'method': 'predict',
+                                'deadline': time.time() + 60})
+    connector._produce('train', {'method': 'train', 'input_': []})
+    connector.broadcast('deploy', input_={'version': 'fake'})
+
+    ttls = {key.decode().rsplit(':', 1)[-1]: connector.redis.ttl(key)
+            for key in payloads(connector)}
+
+    assert ttls.pop('late') > 5
+    # No expiry
+    assert ttls.pop('train') == -1
+    assert list(ttls.values()) == [5]
+
+
+def test_missing_train_payload_fails_the_request():
+    connector = dispatcher(claim_check_threshold=1)
+    connector._produce('reply-train', {'method': 'train', 'input_': []})
+    for key in payloads(connector):
+        connector.redis.delete(key)
+    serve_in_thread(FakeService())
+
+    _, reply = connector._consume('reply-train', time.time() + 5)
+
+    assert reply[ERROR]['status'] == 410
@@ -0,0 +1,79 @@
+import time
+
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+class VersionedService(FakeService):
+
+    def __init__(self):
+        super().__init__()
+        self._config['availables'].append({'version': 'v2', 'scores': None})
+
+
+def acknowledged(connector, control_id):
+    def check():
+        acks = [ack for ack in connector.workers().values()
+                if ack['control_id'] == control_id]
+        return acks[0] if acks else None
+    return check
+
+
+def test_deploy_is_acknowledged_with_the_new_version(eventually):
+    service = VersionedService()
+    serve_in_thread(service)
+    connector = dispatcher()
+    assert eventually(connector.workers)
+
+    control_id = connector.broadcast('deploy', input_={'version': 'v2'})
+
+    ack = eventually(acknowledged(connector, control_id))
+    assert ack['method'] == 'deploy'
+    assert ack['version'] == 'v2'
+    assert ack['ready']
+    assert 'error' not in ack
+
+
+def test_claim_checked_broadcast_reaches_the_handler(eventually):
+    service = VersionedService()
+    serve_in_thread(service)
+    connector = dispatcher(claim_check_threshold=1)
+    assert eventually(connector.workers)
+
+    control_id = connector.broadcast('deploy', input_={'version': 'v2'})
+
+    ack = eventually(acknowledged(connector, control_id))
+    assert 'error' not in ack
+    assert service.version.version == 'v2'
+
+
+def test_unknown_version_is_acknowledged_with_an_error(eventually):
+    service = VersionedService()
+    serve_in_thread(service)
+    connector = dispatcher()
+    assert eventually(connector.workers)
+
+    control_id = connector.broadcast('deploy', input_={'version': 'nope'})
+
+    ack = eventually(acknowledged(connector, control_id))
+    assert 'nope' in ack['error']
+    assert ack['version'] == 'fake'
+    assert service.version.version == 'fake'
+
+
+def test_sampling_profile_starts_during_a_long_message(eventually):
+    class SlowService(FakeService):
+        def _predict(self, inference_input):
+            time.sleep(1)
+            return super()._predict(inference_input)
+
+    serve_in_thread(SlowService())
+    connector = dispatcher()
+    assert eventually(connector.workers)
+    connector.send('predict', input_={'text': 'slow'})
+    time.sleep(0.1)
+
+    started = connector.collect('profile_start', wait=0.3, kind='sampling')
+    stopped = connector.collect('profile_stop', wait=0.3)
+
+    assert started[0]['result']['kind'] == 'sampling'
+    assert stopped[0]['result']['samples'] > 0
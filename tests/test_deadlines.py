@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+def test_expired_messages_are_skipped():
+    calls = []
+
+    class Service(FakeService):
+        def _predict(self, inference_input):
+            calls.append(inference_input.text)
+            return super()._predict(inference_input)
+
+    connector = dispatcher()
+    connector._produce('late', {'method': 'predict',
+                                'deadline': time.time() - 1,
+                                'input_': {'text': 'late'}})
+    serve_in_thread(Service())
+
+    assert connector.dispatch('predict', input_={'text': 'on time'}
+                              )['prediction'] == 'ON TIME'
+    assert calls == ['on time']
+
+
+def test_train_messages_carry_no_deadline(worker):
+    connector, node = dispatcher(), worker()
+    connector.timeouts = {'train': 0.01}
+    with pytest.raises(ValueError):
+        connector.dispatch('train', input_=[])
+
+    _, kwargs = node._consume_nowait()
+    assert 'deadline' not in kwargs
+    assert not node._expired(kwargs)
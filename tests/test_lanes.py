@@ -0,0 +1,42 @@
+from ml_sdk.communication import BATCH, REALTIME, TRAIN
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+
+
+def test_realtime_lane_is_read_first(worker, drain):
+    connector, node = dispatcher(), worker()
+    connector.send('predict', lane=BATCH, n=1)
+    connector.send('predict', lane=TRAIN, n=2)
+    connector.send('predict', lane=REALTIME, n=3)
+
+    assert [m['n'] for m in drain(node)] == [3, 1, 2]
+
+
+def test_other_lanes_share_the_worker_by_weight(worker, drain):
+    connector, node = dispatcher(), worker()
+    for _ in range(8):
+        connector.send('predict', lane=BATCH, tag=BATCH)
+    for _ in range(8):
+        connector.send('predict', lane=TRAIN, tag=TRAIN)
+
+    first = [m['tag'] for m in drain(node)[:8]]
+
+    # Batch weighs 3 and train 1
+    assert first.count(BATCH) == 6
+    assert first.count(TRAIN) == 2
+
+
+def test_queue_depth_by_lane():
+    connector = dispatcher()
+    connector.send('train', lane=connector.METHOD_LANES['train'])
+    connector.send('predict', lane=BATCH)
+    connector.send('predict', lane=BATCH)
+
+    assert connector.queue_depth() == {REALTIME: 0, BATCH: 2, TRAIN: 1}
+
+
+def test_predict_round_trip():
+    serve_in_thread(FakeService())
+
+    result = dispatcher().dispatch('predict', input_={'text': 'hi'})
+
+    assert result['prediction'] == 'HI'
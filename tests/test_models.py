@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+from ml_sdk.communication import ServiceError
+from ml_sdk.fakes import FakeService, dispatcher, serve_in_thread
+from ml_sdk.io.output import ClassificationOutput
+from ml_sdk.io.version import ModelVersion
+from ml_sdk.service.models import ModelCache
+
+
+def test_least_recently_used_model_is_evicted():
+    cache = ModelCache(max_models=2)
+    cache.get('a', lambda: 'A')
+    cache.get('b', lambda: 'B')
+    cache.get('a', lambda: 'A')
+    cache.get('c', lambda: 'C')
+
+    assert cache.keys() == ['a', 'c']
+
+
+def test_reservations_size_the_cache_when_unbounded():
+    cache = ModelCache()
+    cache.reserve('first', 1)
+    cache.reserve('second', 1)
+    for key in 'abc':
+        cache.get(key, lambda: key)
+
+    assert cache.keys() == ['b', 'c']
+
+
+def test_model_is_loaded_once_and_hits_dont_wait_for_loads():
+    cache = ModelCache()
+    cache.get('loaded', lambda: 'model')
+    loading, release = threading.Event(), threading.Event()
+    loads = []
+
+    def slow_load():
+        loads.append(1)
+        loading.set()
+        release.wait(5)
+        return 'slow'
+
+    threads = [threading.Thread(target=cache.get, args=('slow', slow_load))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    loading.wait(5)
+
+    assert cache.get('loaded', lambda: 'other') == 'model'
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert loads == [1]
+
+
+def test_loads_run_one_at_a_time():
+    cache = ModelCache()
+    running, overlaps = [], []
+
+    def load():
+        running.append(1)
+        overlaps.append(len(running))
+        threading.Event().wait(0.05)
+        running.pop()
+        return 'model'
+
+    threads = [threading.Thread(target=cache.get, args=(key, load))
+               for key in 'abc']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Sizes measured while loading don't count the other loads
+    assert overlaps == [1, 1, 1]
+
+
+class MultiVersionService(FakeService):
+
+    def __init__(self):
+        super().__init__()
+        self._config['availables'].append({'version': 'v2', 'scores': None})
+
+    def _load(self, version):
+        return version.version
+
+    def _predict(self, inference_input):
+        return ClassificationOutput(input=inference_input.dict(),
+                                    prediction=self.current_model, score=1)
+
+
+def test_predict_pinned_to_a_version():
+    serve_in_thread(MultiVersionService())
+    connector = dispatcher()
+
+    assert connector.dispatch('predict', input_={'text': 'x'},
+                              version='v2')['prediction'] == 'v2'
+    assert connector.dispatch('predict', input_={'text': 'x'}
+                              )['prediction'] == 'fake'
+
+
+def test_unknown_version_is_refused_without_stopping_the_worker():
+    serve_in_thread(MultiVersionService())
+    connector = dispatcher()
+
+    with pytest.raises(ServiceError) as error:
+        connector.dispatch('predict', input_={'text': 'x'}, version='nope')
+    assert error.value.status == 404
+    assert connector.dispatch('predict', input_={'text': 'x'}) is not None
+
+
+def test_single_version_service_refuses_other_versions():
+    serve_in_thread(FakeService())
+    connector = dispatcher()
+
+    with pytest.raises(ServiceError) as error:
+        connector.dispatch('predict', input_={'text': 'x'}, version='v2')
+    assert error.value.status == 501
+
+
+def test_split_routes_requests_and_reserves_room():
+    service = MultiVersionService()
+    service.version = ModelVersion(version='fake')
+
+    service.split({'fake': 1, 'v2': 1})
+    predictions = {service.predict({'text': 'x'})['prediction']
+                   for _ in range(30)}
+
+    assert predictions == {'fake', 'v2'}
+    assert sorted(service.models.keys()) == [('fake', 'fake'), ('fake', 'v2')]
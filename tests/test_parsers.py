@@ -0,0 +1,60 @@
+from tempfile import SpooledTemporaryFile
+
+import pytest
+
+from ml_sdk.api.parsers import ArrowCSVFileParser, CSVFileParser
+
+pytest.importorskip('pyarrow')
+
+
+def upload(content: bytes):
+    file = SpooledTemporaryFile()
+    file.write(content)
+    file.seek(0)
+    return file
+
+
+def test_arrow_parser_yields_batches_before_the_end():
+    rows = b"".join(b"row%d,%d\n" % (n, n) for n in range(50000))
+    parser = ArrowCSVFileParser()
+    parser.BATCH_SIZE = 1000
+
+    batches = parser.parse_batches(upload(b"text,n\n" + rows))
+    first = next(batches)
+
+    assert first[0] == {'text': 'row0', 'n': '0'}
+    assert len(first) == 1000
+    assert sum(len(batch) for batch in batches) == 49000
+
+
+def test_latin1_byte_after_the_sample_decodes_the_whole_file():
+    rows = b"".join(b"x%d;%d\n" % (n, n) for n in range(20000))
+    content = b"text;n\n" + rows + "caf\xe9;1\n".encode('latin1')
+    assert len(content) > ArrowCSVFileParser.SAMPLE_SIZE
+
+    items = list(ArrowCSVFileParser().parse(upload(content)))
+
+    assert items[0]['text'] == 'x0'
+    assert items[-1]['text'] == 'café'
+
+
+def test_arrow_parser_matches_pandas_as_text_and_counts_bad_lines():
+    content = b"text,n,day\nhello,1,2024-01-02\nbad,2,3,4\n,4,\n"
+    parser = ArrowCSVFileParser()
+
+    items = list(parser.parse(upload(content)))
+
+    assert items == [{k: str(v) for k, v in item.items()}
+                     for item in CSVFileParser.parse(upload(content))]
+    assert parser.bad_lines == 1
+
+
+def test_column_changing_type_after_the_first_block():
+    rows = b"".join(b"%d,x\n" % n for n in range(300000))
+    parser = ArrowCSVFileParser()
+
+    items = list(parser.parse(upload(b"id,text\n" + rows + b"abc,y\n")))
+
+    assert len(items) == 300001
+    assert items[0] == {'id': '0', 'text': 'x'}
+    assert items[-1] == {'id': 'abc', 'text': 'y'}
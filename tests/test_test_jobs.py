@@ -0,0 +1,85 @@
+import pytest
+
+from ml_sdk.fakes import FakeService, serve_in_thread
+
+
+class ChunkedService(FakeService):
+    TEST_JOB_CHUNK_SIZE = 2
+
+    def _predict(self, inference_input):
+        if inference_input.text == 'bad':
+            raise RuntimeError("bad row")
+        return super()._predict(inference_input)
+
+
+def staged_job(database, texts):
+    job = database.create_test_job(len(texts))
+    database.stage_test_job(job, [{'text': text} for text in texts])
+    return job
+
+
+def finished(database, job):
+    return lambda: database.get_test_job(job.job_id).end_at
+
+
+def test_job_is_scored_in_chunks(eventually):
+    service = ChunkedService()
+    serve_in_thread(service)
+    job = staged_job(service.database, ['a', 'b', 'c', 'd', 'e'])
+
+    service.worker.enqueue('run_test_job', job=job.dict())
+
+    assert eventually(finished(service.database, job))
+    job = service.database.get_test_job(job.job_id)
+    assert job.processed == 5
+    assert sorted(r['prediction'] for r in job.results) == list('ABCDE')
+    assert service.database.pending_test_jobs() == []
+
+
+def test_failing_rows_are_recorded_and_the_job_finishes(eventually):
+    service = ChunkedService()
+    serve_in_thread(service)
+    job = staged_job(service.database, ['a', 'bad', 'c'])
+
+    service.worker.enqueue('run_test_job', job=job.dict())
+
+    assert eventually(finished(service.database, job))
+    job = service.database.get_test_job(job.job_id)
+    assert job.failed == [1]
+    assert job.processed == 2
+
+
+def test_pending_job_resumes_from_its_checkpoint(eventually):
+    service = ChunkedService()
+    job = staged_job(service.database, ['a', 'b', 'c', 'd'])
+    # A worker stopped after the first chunk
+    assert service.database.advance_test_checkpoint(job, 0, 2)
+
+    serve_in_thread(service)
+
+    assert eventually(finished(service.database, job))
+    results = service.database.get_test_job(job.job_id).results
+    assert sorted(r['prediction'] for r in results) == ['C', 'D']
+
+
+def test_checkpoint_only_moves_from_the_expected_offset():
+    database = ChunkedService().database
+    job = staged_job(database, ['a', 'b', 'c'])
+
+    assert database.advance_test_checkpoint(job, 0, 2)
+    assert not database.advance_test_checkpoint(job, 0, 2)
+    assert database.get_test_checkpoint(job) == 2
+
+
+def test_mongo_checkpoint_only_moves_from_the_expected_offset():
+    pytest.importorskip('mongomock')
+    from ml_sdk.database.mongo import MongoSettings
+    from ml_sdk.fakes import FakeMongoDatabase
+
+    database = FakeMongoDatabase(MongoSettings(db='test_jobs'))
+    job = staged_job(database, ['a', 'b', 'c'])
+
+    assert database.advance_test_checkpoint(job, 0, 2)
+    assert not database.advance_test_checkpoint(job, 0, 2)
+    database.update_test_job_batch(job, {}, failed=[1])
+    assert database.get_test_job(job.job_id).failed == [1]
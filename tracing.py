@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace, propagate
+except ImportError:  # Spans are only created when installed
+    trace = propagate = None
+
+
+enabled = trace is not None
+
+# Server-Timing entries, from one stamp to the next
+STAGES = (
+    ('queue', 'enqueue', 'dequeue'),
+    ('wait', 'dequeue', 'start'),
+    ('handler', 'start', 'end'),
+    ('reply', 'end', 'reply'),
+    ('fetch', 'reply', 'received'),
+    ('total', 'enqueue', 'received'),
+)
+
+
+@contextmanager
+def span(name: str, context: dict = None, **attributes):
+    # Child of the span propagated in `context` when given
+    if trace is None:
+        yield None
+        return
+
+    parent = propagate.extract(context) if context is not None else None
+    tracer = trace.get_tracer('ml_sdk')
+    with tracer.start_as_current_span(name, context=parent,
+                                      attributes=attributes) as current:
+        yield current
+
+
+def inject() -> dict:
+    # Context of the current span, to be carried in a message
+    carrier = {}
+    if propagate is not None:
+        propagate.inject(carrier)
+    return carrier
+
+
+def server_timing(timings: dict) -> str:
+    # Stamps are wall clock seconds from the API and the worker hosts
+    entries = []
+    for name, start, end in STAGES:
+        if timings.get(start) is not None and timings.get(end) is not None:
+            duration = (timings[end] - timings[start]) * 1000
+            entries.append(f"{name};dur={duration:.3f}")
+    return ", ".join(entries)